@@ -4,10 +4,15 @@ from PyQt6 import QtWidgets as qtw
 # to extract file extensions
 import pathlib
 
+# for applying journaled edits
+import numpy
+
 # custom utilities
-from utils import data
 from utils import files
 from utils import project
+from utils import render
+from utils import history
+from utils import optimize
 
 # custom gui widgets
 from gui import mainAppWidgets
@@ -16,15 +21,29 @@ from gui import tilesetEditor
 from gui import chunksetEditor
 from gui import tilemapEditor
 
+# editors in tab order: attribute, tab name, class
+EDITORS = [
+    ("palEdit", "Palettes", paletteEditor.PaletteEditor),
+    ("tileEdit", "Tileset", tilesetEditor.TilesetEditor),
+    ("chunkEdit", "Chunkset", chunksetEditor.ChunksetEditor),
+    ("mapEdit", "Tilemap", tilemapEditor.TilemapEditor)
+]
+
+# changes queued for a hidden editor before it is redrawn from scratch instead
+MAX_PENDING_CHANGES = 64
+
 class Application(qtw.QMainWindow):
     """ Main application class. """
-    def __init__(self):
+    def __init__(self, historyMemoryLimit: int=history.DEFAULT_MEMORY_LIMIT):
         super().__init__()
 
         # create a blank new project
         self.filename = "untitled.tge"
         self.projectData = project.NewProjectFile()
 
+        # journal of edits for undo/redo (forgets the oldest edits past the memory limit)
+        self.history = history.History(historyMemoryLimit)
+
         # create main enviroment
         self.ResetMainGui()
 
@@ -38,57 +57,157 @@ class Application(qtw.QMainWindow):
         self.menu = mainAppWidgets.MenuBar(self)
         self.setMenuBar(self.menu)
 
-        # windows for differnet editors
+        # shared cache of rendered tiles used by every editor
+        self.atlas = render.TileAtlas(self.projectData.palettes, self.projectData.tileset)
+
+        # edits of the previous project can't be undone
+        self.history.Clear()
+        self.HistoryChanged()
+
+        # windows for differnet editors (each one is built and drawn the first time its tab is shown)
         self.editors = qtw.QTabWidget(self)
-        # - palette editor
-        self.palEdit = paletteEditor.PaletteEditor(self)
-        self.editors.addTab(self.palEdit, "Palettes")
-        # - tileset editor
-        self.tileEdit = tilesetEditor.TilesetEditor(self)
-        self.editors.addTab(self.tileEdit, "Tileset")
-        # - chunkset editor
-        self.chunkEdit = chunksetEditor.ChunksetEditor(self)
-        self.editors.addTab(self.chunkEdit, "Chunkset")
-        # - tilemap editor
-        self.mapEdit = tilemapEditor.TilemapEditor(self)
-        self.editors.addTab(self.mapEdit, "Tilemap")
+        for attribute, name, editorClass in EDITORS:
+            setattr(self, attribute, None)
+            self.editors.addTab(qtw.QWidget(), name) # placeholder
+        
+        # changes to apply to each editor when it is next shown (None = redraw from scratch)
+        self.pendingChanges = [[] for editor in EDITORS]
+
         # set the central widget
+        self.BuildEditor(0)
+        self.editors.currentChanged.connect(self.EditorShown)
         self.setCentralWidget(self.editors)
+    
+    def BuildEditor(self, index: int):
+        """ Build an editor in place of its placeholder tab, link its signals, and draw it. """
+        attribute, name, editorClass = EDITORS[index]
+        editor = editorClass(self)
+        setattr(self, attribute, editor)
+
+        # swap out the placeholder without it counting as a tab change
+        currentIndex = self.editors.currentIndex()
+        placeholder = self.editors.widget(index)
+        self.editors.blockSignals(True)
+        self.editors.removeTab(index)
+        self.editors.insertTab(index, editor, name)
+        self.editors.setCurrentIndex(currentIndex)
+        self.editors.blockSignals(False)
+        placeholder.deleteLater()
 
         # link signals
-        # - change in palette
-        for pv in self.palEdit.palettePanel.visuals:
-            # -- tileset editor
-            pv.paletteChange.connect(self.tileEdit.colorPanel.picker.ResetImage)
-            pv.paletteChange.connect(self.tileEdit.tilesetPanel.ResetImage)
-            # -- chunkset editor
-            pv.paletteChange.connect(self.chunkEdit.tilePanel.picker.ResetImage)
-            pv.paletteChange.connect(self.chunkEdit.tilePanel.palPicker.ResetImage)
-            pv.paletteChange.connect(self.chunkEdit.chunksetPanel.ResetImage)
-            # -- tilemap editor
-            pv.paletteChange.connect(self.mapEdit.chunkPanel.picker.ResetImage)
-            pv.paletteChange.connect(self.mapEdit.tilemapPanel.ResetImage)
-        # - change in tile
-        # -- chunkset editor
-        self.tileEdit.tilesetPanel.tileChange.connect(self.chunkEdit.tilePanel.picker.ResetImage)
-        self.tileEdit.tilesetPanel.tileChange.connect(self.chunkEdit.chunksetPanel.ResetImage)
-        # -- tilemap editor
-        self.tileEdit.tilesetPanel.tileChange.connect(self.mapEdit.chunkPanel.picker.ResetImage)
-        self.tileEdit.tilesetPanel.tileChange.connect(self.mapEdit.tilemapPanel.ResetImage)
-        # - change in chunk
-        self.chunkEdit.chunksetPanel.chunkChange.connect(self.mapEdit.chunkPanel.picker.ResetImage)
-        self.chunkEdit.chunksetPanel.chunkChange.connect(self.mapEdit.tilemapPanel.ResetImage)
-
-        # reset everything
-        for i in range(4):
-            self.palEdit.palettePanel.visuals[i].ResetImage()
-        self.tileEdit.colorPanel.picker.ResetImage()
-        self.tileEdit.tilesetPanel.ResetImage()
-        self.chunkEdit.tilePanel.picker.ResetImage()
-        self.chunkEdit.tilePanel.palPicker.ResetImage()
-        self.chunkEdit.chunksetPanel.ResetImage()
-        self.mapEdit.chunkPanel.picker.ResetImage()
-        self.mapEdit.tilemapPanel.ResetImage()
+        if editor is self.palEdit: # - change in palette
+            for pv in self.palEdit.palettePanel.visuals:
+                pv.paletteChange.connect(self.PaletteChanged)
+        elif editor is self.tileEdit: # - change in tile
+            self.tileEdit.tilesetPanel.tileChange.connect(self.TilesChanged)
+        elif editor is self.chunkEdit: # - change in chunk
+            self.chunkEdit.chunksetPanel.chunkChange.connect(self.ChunksChanged)
+
+        # draw everything
+        self.pendingChanges[index] = []
+        editor.ResetImage()
+    
+    def EditorShown(self, index: int):
+        """ Build the editor of a tab the first time it is shown, otherwise apply the changes it missed while hidden. """
+        if getattr(self, EDITORS[index][0]) is None:
+            self.BuildEditor(index)
+            return
+        
+        editor = getattr(self, EDITORS[index][0])
+        pending, self.pendingChanges[index] = self.pendingChanges[index], []
+        if pending is None:
+            editor.ResetImage()
+            return
+        for change, args in pending:
+            getattr(editor, change)(*args)
+    
+    def NotifyEditors(self, change: str, *args):
+        """ Send a change to every editor that handles it: the shown one redraws now, hidden ones when they are next shown, and unbuilt ones are drawn from scratch when built. """
+        for index, (attribute, name, editorClass) in enumerate(EDITORS):
+            editor = getattr(self, attribute)
+            if editor is None or not hasattr(editor, change):
+                continue
+
+            if index == self.editors.currentIndex():
+                getattr(editor, change)(*args)
+            elif self.pendingChanges[index] is not None:
+                # too many missed changes are cheaper to redraw from scratch
+                self.pendingChanges[index].append((change, args))
+                if len(self.pendingChanges[index]) > MAX_PENDING_CHANGES:
+                    self.pendingChanges[index] = None
+    
+    def PaletteChanged(self, paletteIndex: int):
+        """ Recolor everything that uses a changed palette. """
+        # chunks with any tile in the palette
+        chunkIds = self.projectData.chunkset.ChunksUsingPalette(paletteIndex)
+        self.NotifyEditors("PaletteChanged", paletteIndex, chunkIds)
+    
+    def TilesChanged(self, tileIds: list[int]):
+        """ Redraw everything that uses changed tiles. """
+        # chunks that reference any of the tiles
+        chunkIds = self.projectData.chunkset.ChunksUsingTiles(tileIds)
+        self.NotifyEditors("TilesChanged", tileIds, chunkIds)
+    
+    def ChunksChanged(self, chunkIds: list[int]):
+        """ Redraw everything that uses changed chunks. """
+        self.NotifyEditors("ChunksChanged", chunkIds)
+    
+    def EndStroke(self):
+        """ Journal the stroke an editor just finished. """
+        self.history.EndStroke()
+        self.HistoryChanged()
+    
+    def HistoryChanged(self):
+        """ Only enable Undo/Redo when there is an edit to undo/redo. """
+        self.menu.optionActions["Undo"].setEnabled(self.history.CanUndo())
+        self.menu.optionActions["Redo"].setEnabled(self.history.CanRedo())
+    
+    def Undo(self):
+        """ Revert the newest edit. """
+        delta = self.history.Undo()
+        if delta is not None:
+            self.ApplyDelta(delta, delta.old)
+        self.HistoryChanged()
+    
+    def Redo(self):
+        """ Reapply the newest undone edit. """
+        delta = self.history.Redo()
+        if delta is not None:
+            self.ApplyDelta(delta, delta.new)
+        self.HistoryChanged()
+    
+    def ApplyDelta(self, delta: history.Delta, values: numpy.ndarray):
+        """ Write one side of a journaled edit back into the project and redraw what it touched. """
+        cells = delta.cells.astype(numpy.intp)
+
+        if delta.target == "palette":
+            # write the colors back then recolor every palette they belong to
+            for cell, value in zip(cells.tolist(), values.tolist()):
+                self.projectData.palettes[cell // 16].AddColor(history.UnpackColor(value), cell % 16)
+            for paletteIndex in numpy.unique(cells // 16).tolist():
+                self.atlas.InvalidatePalette(paletteIndex)
+                self.PaletteChanged(paletteIndex)
+        
+        elif delta.target == "tileset":
+            # write the pixels back then redraw the tiles they belong to
+            self.projectData.tileset.set.reshape(-1)[cells] = values
+            tileIds = numpy.unique(cells // 64)
+            self.atlas.InvalidateTiles(tileIds)
+            self.TilesChanged(tileIds.tolist())
+        
+        elif delta.target == "chunkset":
+            # write the tiles back then redraw the chunks they belong to
+            chunkset = self.projectData.chunkset
+            chunkset.SetWords(cells, values)
+            chunkIds = numpy.unique(cells // (chunkset.chunkSize * chunkset.chunkSize))
+            self.ChunksChanged(chunkIds.tolist())
+        
+        elif delta.target == "tilemap":
+            # write the chunks back then redraw the cells
+            tilemap = self.projectData.tilemap
+            tilemap.SetWords(cells, values)
+            cellsY, cellsX = numpy.unravel_index(cells, tilemap.map.shape)
+            self.NotifyEditors("CellsChanged", cellsX, cellsY)
     
     def SaveNewProjectFile(self):
         """ Save the project as a new file. """
@@ -114,39 +233,8 @@ class Application(qtw.QMainWindow):
             self.SaveNewProjectFile()
             return
 
-        # convert the project data to json
-        jsonData = {
-            "palettes": [
-                [(col.red, col.green, col.blue) for col in pal.palette] for pal in self.projectData.palettes
-            ],
-
-            "tileset": {
-                "size": self.projectData.tileset.size,
-                "set": self.projectData.tileset.set
-            },
-
-            "chunkset": {
-                "size": self.projectData.chunkset.size,
-                "chunkSize": self.projectData.chunkset.chunkSize,
-                "set": [
-                    [
-                        [(tile.palette, tile.id, tile.priority, tile.hFlip, tile.vFlip) for tile in row] for row in chunk
-                    ] for chunk in self.projectData.chunkset.set
-                ]
-            },
-
-            "tilemap": {
-                "size": self.projectData.tilemap.size,
-                "map": [
-                    [
-                        (chunk.id, chunk.hFlip, chunk.vFlip) for chunk in row
-                    ] for row in self.projectData.tilemap.map
-                ]
-            }
-        }
-
-        # write the json
-        files.WriteJson(jsonData, self.filename)
+        # write the binary project file
+        project.WriteProjectFile(self.projectData, self.filename)
     
     def LoadProjectFile(self):
         """ Load a file into the project. """
@@ -162,56 +250,30 @@ class Application(qtw.QMainWindow):
         
         self.filename = dialog.selectedFiles()[0] # we only want the first file
         
-        # read the file as json
-        jsonData = files.ReadJson(self.filename)
-
-        # redefine palettes with json data
-        self.projectData.palettes = [
-            data.Palette(
-                [data.Color(col[0], col[1], col[2]) for col in jsonData["palettes"][palIndex]]
-            ) for palIndex in range(4)
-        ]
-        
-        # redefine tileset with json data
-        self.projectData.tileset = data.Tileset(jsonData["tileset"]["size"], jsonData["tileset"]["set"])
-        
-        # redefine chunkset with json data
-        self.projectData.chunkset = data.Chunkset(
-            jsonData["chunkset"]["size"],
-            jsonData["chunkset"]["chunkSize"],
-
-            [
-                [
-                    [
-                        data.Tile(
-                            tile[0], # palette index
-                            tile[1], # tile id
-                            tile[2], # tile priority
-                            tile[3], # tile horizontal flip
-                            tile[4] # tile vertical flip
-                        ) for tile in row
-                    ] for row in chunk
-                ] for chunk in jsonData["chunkset"]["set"]
-            ]
-        )
-        
-        # redefine tilemap with json data
-        self.projectData.tilemap = data.Tilemap(
-            jsonData["tilemap"]["size"],
-
-            [
-                [
-                    data.Chunk(
-                        chunk[0], # chunk id
-                        chunk[1], # chunk horizontal flip
-                        chunk[2] # chunk vertical flip
-                    ) for chunk in row
-                ] for row in jsonData["tilemap"]["map"]
-            ]
-        )
+        # read the project (old json projects are converted on load)
+        self.projectData = project.ReadProjectFile(self.filename)
 
         self.ResetMainGui()
     
+    def OptimizeProject(self, type: str):
+        """ Run an optimization pass over the project (this can't be undone). """
+        # remember the sizes to report what was saved
+        tiles, chunks = self.projectData.tileset.size, self.projectData.chunkset.size
+
+        if type == "Merge Duplicate Tiles":
+            optimize.MergeTiles(self.projectData)
+            report = f"Merged {tiles} tiles into {self.projectData.tileset.size}."
+        elif type == "Merge Duplicate Chunks":
+            optimize.MergeChunks(self.projectData)
+            report = f"Merged {chunks} chunks into {self.projectData.chunkset.size}."
+        elif type == "Remove Unused Tiles/Chunks":
+            savedBytes = optimize.RemoveUnused(self.projectData)
+            report = f"Removed {tiles - self.projectData.tileset.size} tiles and {chunks - self.projectData.chunkset.size} chunks, saving {savedBytes} bytes."
+
+        # reset gui (ids changed, so the undo journal starts over)
+        self.ResetMainGui()
+        qtw.QMessageBox.information(self, type, report)
+
     def ImportFile(self, type: str):
         """ Import data into the project. """
         # get type of import
@@ -249,7 +311,7 @@ class Application(qtw.QMainWindow):
             # create file dialog
             dialog = qtw.QFileDialog(self)
             dialog.setFileMode(qtw.QFileDialog.FileMode.ExistingFiles)
-            dialog.setNameFilter("All Files (*.*);;Image files (*.png, *.bmp, *.jpg);;Assembly Files (*.asm, *.s);;Binary Files (*.bin)")
+            dialog.setNameFilter("All Files (*.*);;Image files (*.png, *.bmp, *.jpg);;Assembly Files (*.asm, *.s);;Binary Files (*.bin);;Kosinski Files (*.kos)")
             dialog.setViewMode(qtw.QFileDialog.ViewMode.Detail)
 
             # if a file is not chosen
@@ -266,6 +328,15 @@ class Application(qtw.QMainWindow):
                 self.projectData.tileset = files.ExtractTilesetBin(files.ExtractBinDataAsm(file))
             elif ext == ".bin":
                 self.projectData.tileset = files.ExtractTilesetBin(files.ExtractBytes(file))
+            elif ext == ".kos":
+                self.projectData.tileset = files.ExtractTilesetBin(files.DecompressKosinski(files.ExtractBytes(file)))
+            else: # nothing was imported
+                return
+
+            # offer to merge repeated and mirrored tiles
+            answer = qtw.QMessageBox.question(self, "Merge Tiles", "Merge duplicate and mirrored tiles? (the chunkset is updated to match)")
+            if answer == qtw.QMessageBox.StandardButton.Yes:
+                optimize.MergeTiles(self.projectData)
 
             # reset gui
             self.ResetMainGui()
@@ -274,7 +345,7 @@ class Application(qtw.QMainWindow):
             # create file dialog
             dialog = qtw.QFileDialog(self)
             dialog.setFileMode(qtw.QFileDialog.FileMode.ExistingFiles)
-            dialog.setNameFilter("All Files (*.*);;Assembly Files (*.asm, *.s);;Binary Files (*.bin)")
+            dialog.setNameFilter("All Files (*.*);;Assembly Files (*.asm, *.s);;Binary Files (*.bin);;Kosinski Files (*.kos)")
             dialog.setViewMode(qtw.QFileDialog.ViewMode.Detail)
 
             # if a file is not chosen
@@ -294,6 +365,8 @@ class Application(qtw.QMainWindow):
                 self.projectData.chunkset = files.ExtractChunksetBin(files.ExtractBinDataAsm(file), chunkSize)
             elif ext == ".bin":
                 self.projectData.chunkset = files.ExtractChunksetBin(files.ExtractBytes(file), chunkSize)
+            elif ext == ".kos":
+                self.projectData.chunkset = files.ExtractChunksetBin(files.DecompressKosinski(files.ExtractBytes(file)), chunkSize)
 
             # reset gui
             self.ResetMainGui()
@@ -329,6 +402,30 @@ class Application(qtw.QMainWindow):
             # reset gui
             self.ResetMainGui()
 
+        elif type == "Level Image":
+            # create file dialog
+            dialog = qtw.QFileDialog(self)
+            dialog.setFileMode(qtw.QFileDialog.FileMode.ExistingFiles)
+            dialog.setNameFilter("Image files (*.png, *.bmp)")
+            dialog.setViewMode(qtw.QFileDialog.ViewMode.Detail)
+
+            # if a file is not chosen
+            if not (dialog.exec() and dialog.selectedFiles()):
+                return
+
+            file = dialog.selectedFiles()[0] # we only want the first file
+
+            # replace the palettes, tileset, chunkset and tilemap (chunks keep the project's size)
+            try:
+                palettes, tileset, chunkset, tilemap = files.ExtractLevelImg(file, self.projectData.chunkset.chunkSize)
+            except ValueError as error:
+                qtw.QMessageBox.warning(self, "Import Level Image", str(error))
+                return
+            self.projectData.palettes, self.projectData.tileset, self.projectData.chunkset, self.projectData.tilemap = palettes, tileset, chunkset, tilemap
+
+            # reset gui
+            self.ResetMainGui()
+
     def ExportFile(self, type: str):
         # get type of export
         if type == "Palette":
@@ -350,13 +447,14 @@ class Application(qtw.QMainWindow):
                 with open(file, "w") as f:
                     f.write(files.ExportPaletteAsm(self.projectData.palettes))
             elif ext == ".bin":
-                pass
+                with open(file, "wb") as f:
+                    f.write(files.ExportPaletteBin(self.projectData.palettes))
 
         elif type == "Tileset":
             # create file dialog
             dialog = qtw.QFileDialog(self)
             dialog.setFileMode(qtw.QFileDialog.FileMode.AnyFile)
-            dialog.setNameFilter("Assembly Files (*.asm, *.s);;Binary Files (*.bin)")
+            dialog.setNameFilter("Assembly Files (*.asm, *.s);;Binary Files (*.bin);;Kosinski Files (*.kos)")
             dialog.setViewMode(qtw.QFileDialog.ViewMode.Detail)
 
             # if a file is not chosen
@@ -371,13 +469,17 @@ class Application(qtw.QMainWindow):
                 with open(file, "w") as f:
                     f.write(files.ExportTilesetAsm(self.projectData.tileset))
             elif ext == ".bin":
-                pass
+                with open(file, "wb") as f:
+                    f.write(files.ExportTilesetBin(self.projectData.tileset))
+            elif ext == ".kos":
+                with open(file, "wb") as f:
+                    f.write(files.CompressKosinski(files.ExportTilesetBin(self.projectData.tileset)))
 
         elif type == "Chunkset":
             # create file dialog
             dialog = qtw.QFileDialog(self)
             dialog.setFileMode(qtw.QFileDialog.FileMode.AnyFile)
-            dialog.setNameFilter("Assembly Files (*.asm, *.s);;Binary Files (*.bin)")
+            dialog.setNameFilter("Assembly Files (*.asm, *.s);;Binary Files (*.bin);;Kosinski Files (*.kos)")
             dialog.setViewMode(qtw.QFileDialog.ViewMode.Detail)
 
             # if a file is not chosen
@@ -392,7 +494,11 @@ class Application(qtw.QMainWindow):
                 with open(file, "w") as f:
                     f.write(files.ExportChunksetAsm(self.projectData.chunkset))
             elif ext == ".bin":
-                pass
+                with open(file, "wb") as f:
+                    f.write(files.ExportChunksetBin(self.projectData.chunkset))
+            elif ext == ".kos":
+                with open(file, "wb") as f:
+                    f.write(files.CompressKosinski(files.ExportChunksetBin(self.projectData.chunkset)))
 
         elif type == "Tilemap":
             # create file dialog
@@ -413,5 +519,6 @@ class Application(qtw.QMainWindow):
                 with open(file, "w") as f:
                     f.write(files.ExportTilemapAsm(self.projectData.tilemap))
             elif ext == ".bin":
-                pass
+                with open(file, "wb") as f:
+                    f.write(files.ExportTilemapBin(self.projectData.tilemap))
 
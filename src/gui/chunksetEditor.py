@@ -7,6 +7,9 @@ from . import common
 # for custom data types
 from utils import data
 
+# for composing tile images
+from utils import render
+
 # for rounding
 import math
 
@@ -33,12 +36,9 @@ class TilePicker(qtw.QGraphicsView):
         self.graphicsScene = qtw.QGraphicsScene()
         self.setScene(self.graphicsScene)
 
-        # define the tile choice img
-        self.img = qtg.QPixmap(8, self.tileset.size * 8)
-        self.img.fill(qtg.QColor(0, 0, 0)) # fill with black
-
-        # create the label holding the img
-        self.pixmapItem = self.graphicsScene.addPixmap(self.img)
+        # tile choice canvas of color indices within the current palette
+        self.canvas = common.CanvasItem((8, self.tileset.size * 8), mainApplication.atlas.ColorTable(0))
+        self.graphicsScene.addItem(self.canvas)
 
         # create selection overlay
         self.overlay = qtg.QPixmap(8, self.tileset.size * 8)
@@ -52,11 +52,6 @@ class TilePicker(qtw.QGraphicsView):
         # always have vertical scroll bar
         self.setVerticalScrollBarPolicy(qtc.Qt.ScrollBarPolicy.ScrollBarAlwaysOn)
 
-        # create image once to edit later
-        width = self.img.width()
-        height = self.img.height()
-        self.image = qtg.QImage(width, height, qtg.QImage.Format.Format_ARGB32)
-
         # set the scale
         self.resetTransform()
         self.scale(self.imgScale // 8, self.imgScale // 8)
@@ -69,6 +64,9 @@ class TilePicker(qtw.QGraphicsView):
         # select
         self.DrawSelect(y)
 
+        # show how many chunk cells use the tile
+        self.setToolTip(f"Tile {y}: used {self.mainApplication.projectData.chunkset.TileUsage(y)} times in the chunkset")
+
         # emit color signal
         self.tileSelected.emit(y)
     
@@ -83,51 +81,39 @@ class TilePicker(qtw.QGraphicsView):
     
     def SetProperties(self, priority: bool, palette: int, hFlip: bool, vFlip: bool):
         """ Set the properties of what is selected. """
+        flipped = (hFlip, vFlip) != (self.currentHFlip, self.currentVFlip)
         self.currentPaletteIndex = palette
         self.currentHFlip = hFlip
         self.currentVFlip = vFlip
 
-        # redraw the image
-        self.ResetImage()
+        # redraw the image for new flips, a new palette only recolors it
+        if flipped:
+            self.ResetImage()
+        else:
+            self.canvas.SetColorTable(self.mainApplication.atlas.ColorTable(palette))
+    
+    def RefreshTiles(self, tileIds: list[int]):
+        """ Redraw only the changed tiles. """
+        # grab the tiles pre-rendered as colors within a palette in the current flip
+        tiles = self.mainApplication.atlas.GetTiles(0, (self.currentVFlip << 1) | self.currentHFlip)
+
+        # blit the changed tiles into their slots on the canvas
+        self.canvas.array.reshape(-1, 8, 8)[tileIds] = tiles[tileIds]
+        self.canvas.update()
+    
+    def RefreshPalette(self, paletteIndex: int):
+        """ Recolor the image if the palette being shown changed. """
+        if paletteIndex == self.currentPaletteIndex:
+            self.canvas.SetColorTable(self.mainApplication.atlas.ColorTable(paletteIndex))
 
     def ResetImage(self):
         """ Redraw the image. """
-        # create blank image
-        width = self.img.width()
-        height = self.img.height()
-
-        # grab palette/tileset data
-        palette = self.mainApplication.projectData.palettes[self.currentPaletteIndex].palette
-        tileset = self.mainApplication.projectData.tileset.set
-
-        # convert palette to 32bit ARGB (Alpha, Red, Green, Blue)
-        npPalette = numpy.array([
-            # 1st color in palette is transparent
-            ((0x00 if i == 0 else 0xFF) << 24) | (c.red << 16) | (c.green << 8) | c.blue
-            for i, c in enumerate(palette)
-        ], dtype=numpy.uint32)
-
-        # access raw image buffer
-        pointer = self.image.bits()
-        pointer.setsize(width * height * 4)
-        imageArray = numpy.ndarray((height, width), dtype=numpy.uint32, buffer=pointer)
-
-        # draw tiles into the numpy buffer
-        for i, tile in enumerate(tileset):
-            y = i * 8
-            tileData = npPalette[numpy.array(tile, dtype=numpy.uint8)]
-            
-            # apply flips based on flags
-            if self.currentHFlip:
-                for row in range(8):
-                    tileData[row] = tileData[row][::-1] # flip each row within the tile
-            if self.currentVFlip:
-                tileData = tileData[::-1] # flip the tile data horizontally
-
-            imageArray[y:y+8, :8] = tileData
-        
-        self.img = qtg.QPixmap.fromImage(self.image)
-        self.pixmapItem.setPixmap(self.img)
+        # grab the tiles pre-rendered as colors within a palette in the current flip
+        tiles = self.mainApplication.atlas.GetTiles(0, (self.currentVFlip << 1) | self.currentHFlip)
+
+        # stack the tiles into one column on the canvas
+        self.canvas.array[:] = render.Sheet(tiles, 1)
+        self.canvas.SetColorTable(self.mainApplication.atlas.ColorTable(self.currentPaletteIndex))
 
 class PalettePicker(qtw.QLabel):
     """ To select working palette."""
@@ -317,7 +303,7 @@ class TilePanel(qtw.QWidget):
 class ChunksetPanel(qtw.QGraphicsView):
     """ Panel allowing you to edit chunksets. """
     # signal for change in chunk
-    chunkChange = qtc.pyqtSignal()
+    chunkChange = qtc.pyqtSignal(list) # ids of the changed chunks
 
     def __init__(self, mainApplication: object):
         super().__init__()
@@ -336,17 +322,16 @@ class ChunksetPanel(qtw.QGraphicsView):
         self.graphicsScene = qtw.QGraphicsScene()
         self.setScene(self.graphicsScene)
 
-        # pixmap
-        self.pixmap = qtg.QPixmap(32 * self.chunkSize * 8, 64 * self.chunkSize * 8)
-        self.pixmap.fill(qtg.QColor(0, 0, 0, 0))
-        self.pixmapItem = self.graphicsScene.addPixmap(self.pixmap)
+        # canvas of color indices into every palette, edited in place
+        self.canvas = common.CanvasItem((32 * self.chunkSize * 8, 64 * self.chunkSize * 8), mainApplication.atlas.ColorTable())
+        self.graphicsScene.addItem(self.canvas)
 
-        # draw a grid ontop of the pixmap
-        self.graphicsScene.addItem(common.GridOverlay((self.pixmap.width(), self.pixmap.height()), 8 * self.chunkSize))
+        # draw a grid ontop of the canvas
+        self.graphicsScene.addItem(common.GridOverlay((self.canvas.width(), self.canvas.height()), 8 * self.chunkSize))
 
         # set scroll area and center
         self.setSceneRect(-5000, -5000, 10000, 10000)
-        self.centerOn(self.pixmapItem)
+        self.centerOn(self.canvas)
 
         # for zoom/scroll
         self._lastPos = qtc.QPoint()
@@ -361,6 +346,12 @@ class ChunksetPanel(qtw.QGraphicsView):
         # set palette/color default
         self.currentPaletteIndex = 0
         self.currentTileIndex = 0
+
+        # chunks edited during the current stroke
+        self.changedChunks = set()
+
+        # chunks edited while the image is rendered in the background
+        self.staleChunks = set()
     
     def drawBackground(self, painter: qtg.QPainter, rect):
         """ Draws a non-scrolling background. """
@@ -395,9 +386,14 @@ class ChunksetPanel(qtw.QGraphicsView):
     
     def mouseReleaseEvent(self, event):
         """ When the mouse is let go. """
-        # send tilechange signal
         if event.button() == qtc.Qt.MouseButton.LeftButton:
-            self.chunkChange.emit()
+            # the stroke is one edit in the journal
+            self.mainApplication.EndStroke()
+
+            # send chunkchange signal with every chunk edited during the stroke
+            if self.changedChunks:
+                self.chunkChange.emit(sorted(self.changedChunks))
+                self.changedChunks.clear()
     
     def wheelEvent(self, event):
         """ When the mouse is scrolled. """
@@ -431,116 +427,93 @@ class ChunksetPanel(qtw.QGraphicsView):
     
     def DrawTiles(self, event: qtg.QMouseEvent):
         """ Draw tiles at event location. """
-        # get the coords within the pixmap
+        # get the coords within the canvas
         coords = (
-            math.floor(self.pixmapItem.mapFromScene(self.mapToScene(event.position().toPoint())).x()),
-            math.floor(self.pixmapItem.mapFromScene(self.mapToScene(event.position().toPoint())).y())
+            math.floor(self.canvas.mapFromScene(self.mapToScene(event.position().toPoint())).x()),
+            math.floor(self.canvas.mapFromScene(self.mapToScene(event.position().toPoint())).y())
         )
 
         # check if out of range
-        if not (0 <= coords[0] < self.pixmap.width() and 0 <= coords[1] < self.pixmap.height()):
+        if not (0 <= coords[0] < self.canvas.width() and 0 <= coords[1] < self.canvas.height()):
             return
         
         # get index in chunkset
         chunkX, chunkY = (coords[0] // 8) // self.chunkSize, (coords[1] // 8) // self.chunkSize
-        chunksPerRow = self.pixmap.width() // (self.chunkSize * 8)
+        chunksPerRow = self.canvas.width() // (self.chunkSize * 8)
         chunkIndex = (chunkY * chunksPerRow) + chunkX
 
         if chunkIndex + 1 > self.mainApplication.projectData.chunkset.size:
             return
         
-        # get the tile data
-        tileArray = self.mainApplication.projectData.tileset.set[self.currentTileIndex][:]
-
-        # get the palette
-        palette = self.mainApplication.projectData.palettes[self.currentPaletteIndex].palette
-
-        # apply flips
-        if self.currentHFlip:
-            for y in range(8):
-                tileArray[y] = tileArray[y][::-1]
-        if self.currentVFlip:
-            tileArray = tileArray[::-1]
-
         # get coords within chunk
         withinX = (coords[0] // 8) % self.chunkSize
         withinY = (coords[1] // 8) % self.chunkSize
 
-        # apply to chunk in chunkset
-        self.mainApplication.projectData.chunkset.set[chunkIndex][withinY][withinX] = data.Tile(self.currentPaletteIndex, self.currentTileIndex, self.currentPriority, self.currentHFlip, self.currentVFlip)
-
-        # create pixmap image
-        pixmapImage = self.pixmap.toImage()
+        # apply to chunk in chunkset and journal the change
+        tile = data.Tile(self.currentPaletteIndex, self.currentTileIndex, self.currentPriority, self.currentHFlip, self.currentVFlip)
+        chunkset = self.mainApplication.projectData.chunkset
+        cell = (chunkIndex * self.chunkSize + withinY) * self.chunkSize + withinX
+        self.mainApplication.history.Record("chunkset", cell, chunkset.set[chunkIndex, withinY, withinX], tile.Pack())
+        chunkset.SetTile(chunkIndex, withinX, withinY, tile)
+        self.changedChunks.add(chunkIndex)
+        if self.canvas.Rendering():
+            self.staleChunks.add(chunkIndex)
+
+        # blit the tile from the shared tile atlas straight into the canvas
+        tileX, tileY = (coords[0] // 8) * 8, (coords[1] // 8) * 8
+        self.canvas.array[tileY:tileY+8, tileX:tileX+8] = self.mainApplication.atlas.Lookup(numpy.uint16(tile.Pack()))
+        self.canvas.MarkDirty(tileX, tileY, 8, 8)
+    
+    def RefreshChunks(self, chunkIds: list[int]):
+        """ Redraw only the changed chunks. """
+        # the image being rendered in the background might miss them
+        if self.canvas.Rendering():
+            self.staleChunks.update(numpy.asarray(chunkIds).tolist())
+
+        # only chunks that fit on the sheet are drawn
+        width, height = self.canvas.width(), self.canvas.height()
+        size = self.chunkSize * 8
+        chunksPerRow = width // size
+        chunkIds = numpy.asarray(chunkIds, dtype=numpy.intp)
+        chunkIds = chunkIds[chunkIds < (height // size) * chunksPerRow]
+        if not len(chunkIds):
+            return
 
-        # apply tile
-        for y in range(8):
-            for x in range(8):
-                # get the color's index
-                colorIndex = tileArray[y][x]
-                # set pixel colors
-                pixmapImage.setPixelColor(((coords[0] // 8) * 8) + x, ((coords[1] // 8) * 8) + y, qtg.QColor(palette[colorIndex].red, palette[colorIndex].green, palette[colorIndex].blue, 0 if colorIndex == 0 else 255))
+        # render the chunks from the shared tile atlas
+        chunks = render.RenderChunks(self.mainApplication.atlas, self.mainApplication.projectData.chunkset, chunkIds)
 
-        # convert back to pixmap and update pixmap item
-        self.pixmap = qtg.QPixmap.fromImage(pixmapImage)
-        self.pixmapItem.setPixmap(self.pixmap)
+        # blit them into their slots on the canvas
+        imageArray = self.canvas.array.reshape(height // size, size, chunksPerRow, size)
+        imageArray[chunkIds // chunksPerRow, :, chunkIds % chunksPerRow, :] = chunks
+        self.canvas.update()
     
+    def RefreshPalette(self):
+        """ Recolor the image after a palette changed. """
+        self.canvas.SetColorTable(self.mainApplication.atlas.ColorTable())
+
     def ResetImage(self):
-        """ Redraw the image. """
-        # create blank image
-        width = self.pixmap.width()
-        height = self.pixmap.height()
-        image = qtg.QImage(width, height, qtg.QImage.Format.Format_ARGB32)
-
-        # grab palette/tileset/chunkset data
-        palettes = self.mainApplication.projectData.palettes
-        tileset = self.mainApplication.projectData.tileset.set
-        chunkset = self.mainApplication.projectData.chunkset.set
-        chunksPerRow = self.pixmap.width() // (self.chunkSize * 8)
-
-        # convert palettes to 32bit ARGB (Alpha, Red, Green, Blue)
-        npPalettes = [numpy.array([
-            # 1st color in palette is transparent
-            ((0x00 if i == 0 else 0xFF) << 24) | (c.red << 16) | (c.green << 8) | c.blue
-            for i, c in enumerate(pal.palette)
-        ], dtype=numpy.uint32) for pal in palettes]
-
-        # access raw image buffer
-        pointer = image.bits()
-        pointer.setsize(width * height * 4)
-        imageArray = numpy.ndarray((height, width), dtype=numpy.uint32, buffer=pointer)
-
-        for chunkIndex, chunk in enumerate(chunkset):
-            # convert chunk index into x, y
-            chunkX, chunkY = (chunkIndex % chunksPerRow) * self.chunkSize * 8, (chunkIndex // chunksPerRow) * self.chunkSize * 8
-
-            # loop for every tile in chunk
-            for yWithinChunk in range(self.chunkSize):
-                for xWithinChunk in range(self.chunkSize):
-                    # tile object
-                    tileObject = chunk[yWithinChunk][xWithinChunk]
-
-                    # get the tile data
-                    tileArray = tileset[tileObject.id]
-
-                    # apply flips
-                    if tileObject.hFlip:
-                        for y in range(8):
-                            tileArray[yWithinChunk] = tileArray[y][::-1]
-                    if tileObject.vFlip:
-                        tileArray = tileArray[::-1]
-
-                    # draw the tile
-                    for yWithinTile in range(8):
-                        for xWithinTile in range(8):
-                            # get the pixel's coords
-                            pixelX, pixelY = chunkX + (xWithinChunk * 8) + xWithinTile, chunkY + (yWithinChunk * 8) + yWithinTile
-
-                            # set pixel colors
-                            imageArray[pixelY, pixelX] = npPalettes[tileObject.palette][tileArray[yWithinTile][xWithinTile]]
+        """ Redraw the image in the background. """
+        atlas, chunkset = self.mainApplication.atlas, self.mainApplication.projectData.chunkset
+        width, height = self.canvas.width(), self.canvas.height()
+
+        def Render() -> numpy.ndarray:
+            # render every chunk from the shared tile atlas and lay them out in a grid
+            chunks = render.RenderChunks(atlas, chunkset)
+            sheet = render.Sheet(chunks, width // (self.chunkSize * 8))[:height]
+
+            # chunks that don't fit are cut off, slots without a chunk stay transparent
+            pixels = numpy.zeros((height, width), dtype=numpy.uint8)
+            pixels[:sheet.shape[0]] = sheet
+            return pixels
         
-        # convert image to pixmap and apply
-        self.pixmap = qtg.QPixmap.fromImage(image)
-        self.pixmapItem.setPixmap(self.pixmap)
+        self.staleChunks.clear()
+        self.canvas.SetColorTable(atlas.ColorTable())
+        self.canvas.RenderInBackground(Render, self.ImageRendered)
+    
+    def ImageRendered(self):
+        """ Redraw the chunks edited while the image was rendered in the background. """
+        chunkIds, self.staleChunks = sorted(self.staleChunks), set()
+        self.RefreshChunks(chunkIds)
 
 class ChunksetEditor(qtw.QWidget):
     """ Editor menu allowing you to edit the project's tileset. """
@@ -568,3 +541,24 @@ class ChunksetEditor(qtw.QWidget):
         layout.addWidget(self.tilePanel)
         layout.addWidget(separator)
         layout.addWidget(self.chunksetPanel)
+    
+    def ResetImage(self):
+        """ Redraw every panel. """
+        self.tilePanel.picker.ResetImage()
+        self.tilePanel.palPicker.ResetImage()
+        self.chunksetPanel.ResetImage()
+    
+    def PaletteChanged(self, paletteIndex: int, chunkIds: list[int]):
+        """ Redraw what uses a changed palette. """
+        self.tilePanel.picker.RefreshPalette(paletteIndex)
+        self.tilePanel.palPicker.ResetImage()
+        self.chunksetPanel.RefreshPalette()
+    
+    def TilesChanged(self, tileIds: list[int], chunkIds: list[int]):
+        """ Redraw what uses changed tiles. """
+        self.tilePanel.picker.RefreshTiles(tileIds)
+        self.chunksetPanel.RefreshChunks(chunkIds)
+    
+    def ChunksChanged(self, chunkIds: list[int]):
+        """ Redraw changed chunks. """
+        self.chunksetPanel.RefreshChunks(chunkIds)
@@ -1,6 +1,336 @@
 # gui
 from PyQt6 import QtWidgets as qtw, QtGui as qtg, QtCore as qtc
 
+# for direct image manipulation
+import numpy
+
+# for the cache of rendered blocks
+import math
+from collections import OrderedDict
+from typing import Callable
+
+# for rendering off the gui thread
+import os
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+# shared threads that render images in the background (numpy releases the gil for bulk copies)
+RENDER_THREADS = ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1), thread_name_prefix="render")
+
+def ImageArray(image: qtg.QImage) -> numpy.ndarray:
+    """ Get a (height, width) view of the raw pixels of an image (8bit color indices or 32bit colors). """
+    # access raw image buffer
+    pointer = image.bits()
+    pointer.setsize(image.bytesPerLine() * image.height())
+
+    # rows are padded to 32bit boundaries
+    dtype = numpy.uint8 if image.depth() == 8 else numpy.uint32
+    rows = numpy.ndarray((image.height(), image.bytesPerLine() // numpy.dtype(dtype).itemsize), dtype=dtype, buffer=pointer)
+    return rows[:, :image.width()]
+
+def IndexedImage(width: int, height: int, colorTable: list[int]) -> qtg.QImage:
+    """ Create an image of color indices that is recolored by swapping its color table. """
+    image = qtg.QImage(width, height, qtg.QImage.Format.Format_Indexed8)
+    image.setColorTable(colorTable)
+    image.fill(0) # transparent
+    return image
+
+class RenderJobs(qtc.QObject):
+    """ Render jobs run on the shared render threads, with results handed back on the gui thread.
+        A newer job (or a cancel) for the same key replaces an in-flight one and its result is dropped. """
+    # signal carrying a finished result back to the gui thread
+    finished = qtc.pyqtSignal(object, int, object) # key, generation, result
+
+    def __init__(self, onFinished: Callable[[object, object], None]):
+        super().__init__()
+        # define globals
+        self.onFinished = onFinished
+        self.generations = {} # generation of the newest job of every key still in flight
+        self.nextGeneration = 0
+
+        # results are delivered through the gui thread's event loop
+        self.finished.connect(self.Deliver)
+    
+    def Submit(self, key: object, render: Callable[[], object]):
+        """ Start rendering in the background, replacing any in-flight job with the same key. """
+        self.nextGeneration += 1
+        self.generations[key] = self.nextGeneration
+        RENDER_THREADS.submit(self.Run, key, self.nextGeneration, render)
+    
+    def Cancel(self, key: object=None):
+        """ Drop the in-flight job of a key (all by default) so its result is ignored. """
+        if key is None:
+            self.generations.clear()
+        else:
+            self.generations.pop(key, None)
+    
+    def Pending(self, key: object=None) -> bool:
+        """ Check if a key (any by default) has a job in flight. """
+        return bool(self.generations) if key is None else key in self.generations
+    
+    def Run(self, key: object, generation: int, render: Callable[[], object]):
+        """ Render on a render thread unless the job was replaced or canceled before it started. """
+        if self.generations.get(key) != generation:
+            return
+        
+        try:
+            result = render()
+        except Exception:
+            traceback.print_exc()
+            result = None # dropped, so the key can be requested again
+        
+        self.finished.emit(key, generation, result)
+    
+    def Deliver(self, key: object, generation: int, result: object):
+        """ Hand a result to the owner on the gui thread if nothing replaced its job meanwhile. """
+        if self.generations.get(key) != generation:
+            return
+        del self.generations[key]
+        if result is not None:
+            try:
+                self.onFinished(key, result)
+            except RuntimeError: # the owner was deleted while rendering
+                pass
+
+class CanvasItem(qtw.QGraphicsItem):
+    """ Persistent image of color indices that is edited in place through numpy and repainted one region at a time. """
+    def __init__(self, imageSize: tuple[int, int], colorTable: list[int]):
+        super().__init__()
+        self.image = IndexedImage(imageSize[0], imageSize[1], colorTable)
+        self.array = ImageArray(self.image)
+
+        # whole image renders run in the background
+        self.jobs = RenderJobs(self.ImageRendered)
+        self.onRendered = None
+
+        # only repaint the exposed part of the image
+        self.setFlag(qtw.QGraphicsItem.GraphicsItemFlag.ItemUsesExtendedStyleOption)
+    
+    def width(self) -> int:
+        """ Width of the image in pixels. """
+        return self.image.width()
+    
+    def height(self) -> int:
+        """ Height of the image in pixels. """
+        return self.image.height()
+
+    def boundingRect(self): # needs to be overridden
+        return qtc.QRectF(0, 0, self.image.width(), self.image.height())
+    
+    def paint(self, painter, option, widget):
+        """ Paint the exposed part of the image. """
+        rect = option.exposedRect.toAlignedRect().intersected(self.image.rect())
+        painter.drawImage(rect, self.image, rect)
+    
+    def MarkDirty(self, x: int, y: int, width: int, height: int):
+        """ Schedule a repaint of an edited region (qt merges repaints until the next frame). """
+        self.update(qtc.QRectF(x, y, width, height))
+    
+    def SetColorTable(self, colorTable: list[int]):
+        """ Recolor the whole image by swapping its colors. """
+        self.image.setColorTable(colorTable)
+        self.update()
+    
+    def RenderInBackground(self, render: Callable[[], numpy.ndarray], onFinished: Callable[[], None] | None=None):
+        """ Render the color indices of the whole image on a render thread, replacing an in-flight render.
+            The image keeps being shown (and edited) until the new one is swapped in. """
+        width, height = self.image.width(), self.image.height()
+
+        def RenderImage() -> qtg.QImage:
+            pixels = render()
+            image = IndexedImage(width, height, [0] * 256)
+            ImageArray(image)[:] = pixels
+            return image
+        
+        self.onRendered = onFinished
+        self.jobs.Submit("image", RenderImage)
+    
+    def Rendering(self) -> bool:
+        """ Check if a background render is in flight. """
+        return self.jobs.Pending()
+    
+    def ImageRendered(self, key: str, image: qtg.QImage):
+        """ Swap in a finished background render, keeping the current colors. """
+        image.setColorTable(self.image.colorTable())
+        self.image = image
+        self.array = ImageArray(image)
+        self.update()
+        if self.onRendered is not None:
+            self.onRendered()
+
+class TiledCanvasItem(qtw.QGraphicsItem):
+    """ Huge image split into square blocks that are only rendered while visible, with the least recently used off-screen blocks dropped.
+        Zoomed out views use smaller copies of the image (levels), each one half the size of the last. """
+    def __init__(self, imageSize: tuple[int, int], blockSize: int, renderBlock: Callable[[qtc.QRect, int], numpy.ndarray], colorTable: list[int], cacheSize: int=256):
+        super().__init__()
+        # define globals
+        self.imageSize = imageSize
+        self.blockSize = blockSize
+        self.renderBlock = renderBlock # renders a rect of the image shrunk 2**level times (color indices at full size, ARGB colors when shrunk)
+        self.colorTable = colorTable
+        self.cacheSize = cacheSize
+
+        # halve until one block covers the whole image
+        self.maxLevel = 0
+        while (blockSize << self.maxLevel) < max(imageSize):
+            self.maxLevel += 1
+
+        # rendered blocks by (level, block x, block y), most recently used last
+        self.blocks = OrderedDict()
+
+        # blocks that aren't cached are rendered in the background while painting
+        self.jobs = RenderJobs(self.BlockRendered)
+
+        # only repaint the exposed part of the image
+        self.setFlag(qtw.QGraphicsItem.GraphicsItemFlag.ItemUsesExtendedStyleOption)
+    
+    def width(self) -> int:
+        """ Width of the image in pixels. """
+        return self.imageSize[0]
+    
+    def height(self) -> int:
+        """ Height of the image in pixels. """
+        return self.imageSize[1]
+
+    def boundingRect(self): # needs to be overridden
+        return qtc.QRectF(0, 0, *self.imageSize)
+    
+    def BlockRect(self, level: int, blockX: int, blockY: int) -> qtc.QRect:
+        """ Get the rect of the full size image covered by a block. """
+        size = self.blockSize << level
+        x, y = blockX * size, blockY * size
+        return qtc.QRect(x, y, min(size, self.imageSize[0] - x), min(size, self.imageSize[1] - y))
+    
+    def GetBlock(self, level: int, blockX: int, blockY: int) -> tuple[qtg.QImage, numpy.ndarray]:
+        """ Get the image and pixels of a block, rendering it if it isn't cached. """
+        key = (level, blockX, blockY)
+        if key in self.blocks:
+            self.blocks.move_to_end(key)
+            return self.blocks[key]
+        
+        # a result rendered in the background would be older
+        self.jobs.Cancel(key)
+        block = self.RenderBlockImage(level, blockX, blockY, self.colorTable)
+        self.CacheBlock(key, block)
+        return block
+    
+    def RenderBlockImage(self, level: int, blockX: int, blockY: int, colorTable: list[int]) -> tuple[qtg.QImage, numpy.ndarray]:
+        """ Render a block into its own image (safe to call from a render thread). """
+        # every shrunk pixel is an average of opaque and transparent pixels, so it is already premultiplied
+        pixels = self.renderBlock(self.BlockRect(level, blockX, blockY), level)
+        if level == 0:
+            image = IndexedImage(pixels.shape[1], pixels.shape[0], colorTable)
+        else:
+            image = qtg.QImage(pixels.shape[1], pixels.shape[0], qtg.QImage.Format.Format_ARGB32_Premultiplied)
+        array = ImageArray(image)
+        array[:] = pixels
+        return image, array
+    
+    def CacheBlock(self, key: tuple[int, int, int], block: tuple[qtg.QImage, numpy.ndarray]):
+        """ Add a rendered block to the cache, forgetting the least recently used blocks. """
+        self.blocks[key] = block
+        while len(self.blocks) > self.cacheSize:
+            self.blocks.popitem(last=False)
+    
+    def BlockRendered(self, key: tuple[int, int, int], block: tuple[qtg.QImage, numpy.ndarray]):
+        """ Cache a block rendered in the background and paint it. """
+        # the colors may have been swapped while it was rendering
+        if key[0] == 0:
+            block[0].setColorTable(self.colorTable)
+        self.CacheBlock(key, block)
+        self.update(qtc.QRectF(self.BlockRect(*key)))
+    
+    def RequestBlock(self, level: int, blockX: int, blockY: int) -> qtg.QImage | None:
+        """ Get the image of a cached block, otherwise start rendering it in the background. """
+        key = (level, blockX, blockY)
+        if key in self.blocks:
+            self.blocks.move_to_end(key)
+            return self.blocks[key][0]
+        if not self.jobs.Pending(key):
+            self.jobs.Submit(key, lambda: self.RenderBlockImage(level, blockX, blockY, self.colorTable))
+        return None
+    
+    def paint(self, painter, option, widget):
+        """ Paint every block that intersects the exposed part of the image, at the level that matches the zoom. """
+        rect = option.exposedRect.toAlignedRect().intersected(qtc.QRect(0, 0, *self.imageSize))
+        if rect.isEmpty():
+            return
+        
+        # shrink by 2 for every halving of the zoom
+        zoom = option.levelOfDetailFromTransform(painter.worldTransform())
+        level = min(self.maxLevel, max(0, math.floor(math.log2(1 / zoom)))) if zoom > 0 else self.maxLevel
+        size = self.blockSize << level
+        
+        for blockY in range(rect.top() // size, rect.bottom() // size + 1):
+            for blockX in range(rect.left() // size, rect.right() // size + 1):
+                image = self.RequestBlock(level, blockX, blockY)
+                if image is not None:
+                    painter.drawImage(qtc.QRectF(blockX * size, blockY * size, image.width() << level, image.height() << level), image)
+                    continue
+
+                # stretch a smaller cached level over the block until it is rendered
+                blockRect = self.BlockRect(level, blockX, blockY)
+                for coarseLevel in range(level + 1, self.maxLevel + 1):
+                    shift = coarseLevel - level
+                    coarse = self.blocks.get((coarseLevel, blockX >> shift, blockY >> shift))
+                    if coarse is None:
+                        continue
+                    coarseRect = self.BlockRect(coarseLevel, blockX >> shift, blockY >> shift)
+                    source = qtc.QRectF((blockRect.x() - coarseRect.x()) / (1 << coarseLevel), (blockRect.y() - coarseRect.y()) / (1 << coarseLevel), blockRect.width() / (1 << coarseLevel), blockRect.height() / (1 << coarseLevel))
+                    painter.drawImage(qtc.QRectF(blockRect), coarse[0], source)
+                    break
+    
+    def Blit(self, x: int, y: int, pixels: numpy.ndarray):
+        """ Write full size pixels into the cached blocks they cover and schedule a repaint (uncached blocks pick them up when rendered). """
+        height, width = pixels.shape
+
+        # blocks rendering in the background might miss the pixels, so they are requested again
+        for key in [key for key in self.jobs.generations if self.BlockRect(*key).intersects(qtc.QRect(x, y, width, height))]:
+            self.jobs.Cancel(key)
+        for (level, blockX, blockY), (image, array) in self.blocks.items():
+            # overlap between the pixels (grown to whole pixels of the level) and the block
+            blockRect = self.BlockRect(level, blockX, blockY)
+            step = 1 << level
+            x0, y0 = max(x // step * step, blockRect.x()), max(y // step * step, blockRect.y())
+            x1, y1 = min(-(-(x + width) // step) * step, blockRect.x() + blockRect.width()), min(-(-(y + height) // step) * step, blockRect.y() + blockRect.height())
+            if x0 >= x1 or y0 >= y1:
+                continue
+            
+            # copy the pixels at full size, otherwise render the overlap again at the block's level
+            if level == 0:
+                array[y0-blockRect.y():y1-blockRect.y(), x0-blockRect.x():x1-blockRect.x()] = pixels[y0-y:y1-y, x0-x:x1-x]
+            else:
+                shrunk = self.renderBlock(qtc.QRect(x0, y0, x1 - x0, y1 - y0), level)
+                left, top = (x0 - blockRect.x()) >> level, (y0 - blockRect.y()) >> level
+                array[top:top+shrunk.shape[0], left:left+shrunk.shape[1]] = shrunk
+        
+        self.update(qtc.QRectF(x, y, width, height))
+    
+    def InvalidateBlocks(self, blocks: list[tuple[int, int]] | None=None, minLevel: int=0):
+        """ Drop full size blocks (all by default) and the smaller levels covering them so they are rendered again the next time they are painted. """
+        if blocks is None:
+            for key in [key for key in self.blocks if key[0] >= minLevel]:
+                del self.blocks[key]
+            for key in [key for key in self.jobs.generations if key[0] >= minLevel]:
+                self.jobs.Cancel(key)
+            self.update()
+            return
+        
+        for level in range(minLevel, self.maxLevel + 1):
+            for key in {(level, blockX >> level, blockY >> level) for blockX, blockY in blocks}:
+                pending = self.jobs.Pending(key)
+                self.jobs.Cancel(key)
+                if self.blocks.pop(key, None) is not None or pending:
+                    self.update(qtc.QRectF(self.BlockRect(*key)))
+
+    def SetColorTable(self, colorTable: list[int]):
+        """ Recolor the full size blocks by swapping their colors. """
+        self.colorTable = colorTable
+        for (level, blockX, blockY), (image, array) in self.blocks.items():
+            if level == 0:
+                image.setColorTable(colorTable)
+        self.update()
+
 class GridOverlay(qtw.QGraphicsItem):
     """ Grid overlay. """
     def __init__(self, imageSize: tuple[int, int], gridSize: int):
@@ -9,6 +339,9 @@ class GridOverlay(qtw.QGraphicsItem):
         self.gridSize = gridSize
         self.setZValue(1) # draw on top
 
+        # only repaint the exposed part of the grid
+        self.setFlag(qtw.QGraphicsItem.GraphicsItemFlag.ItemUsesExtendedStyleOption)
+
     def boundingRect(self): # needs to be overridden
         return qtc.QRectF(0, 0, *self.imageSize)
     
@@ -17,10 +350,15 @@ class GridOverlay(qtw.QGraphicsItem):
         # define the pen
         painter.setPen(qtg.QPen(qtg.QColor(255, 255, 255), 0.0))
 
+        # only gridlines within the exposed rect
+        rect = option.exposedRect
+        left, right = max(0, int(rect.left()) // self.gridSize * self.gridSize), min(self.imageSize[0], int(rect.right()) + 1)
+        top, bottom = max(0, int(rect.top()) // self.gridSize * self.gridSize), min(self.imageSize[1], int(rect.bottom()) + 1)
+
         # draw vertical gridlines
-        for x in range(0, self.imageSize[0] + 1, self.gridSize):
-            painter.drawLine(x, 0, x, self.imageSize[1])
+        for x in range(left, right + 1, self.gridSize):
+            painter.drawLine(x, top, x, bottom)
         
         # draw horizontal gridlines
-        for y in range(0, self.imageSize[1] + 1, self.gridSize):
-            painter.drawLine(0, y, self.imageSize[0], y)
+        for y in range(top, bottom + 1, self.gridSize):
+            painter.drawLine(left, y, right, y)
@@ -22,7 +22,7 @@ class MenuBar(qtw.QMenuBar):
                 "Save As",
                 None, # use None as a seperator
                 {
-                "Import": ["Palette", "Tileset", "Chunkset", "Tilemap"]
+                "Import": ["Palette", "Tileset", "Chunkset", "Tilemap", "Level Image"]
                 },
                 {
                 "Export": ["Palette", "Tileset", "Chunkset", "Tilemap"]
@@ -31,9 +31,19 @@ class MenuBar(qtw.QMenuBar):
                 "Quit"
             ],
             "Edit": ["Undo", "Redo"],
-            "View": []
+            "View": [],
+            "Tools": ["Merge Duplicate Tiles", "Merge Duplicate Chunks", "Remove Unused Tiles/Chunks"]
         }
 
+        # keyboard shortcuts of options
+        shortcuts = {
+            "Undo": qtg.QKeySequence.StandardKey.Undo,
+            "Redo": qtg.QKeySequence.StandardKey.Redo
+        }
+
+        # actions of top level options by name (to enable/disable them later)
+        self.optionActions = {}
+
         # add each option
         for menuName, items in options.items(): # loop over every menu
             menu = self.addMenu(menuName) # create each menu
@@ -48,8 +58,11 @@ class MenuBar(qtw.QMenuBar):
                             subMenu.addAction(action)
                     else: # the item is not a submenu
                         action = qtg.QAction(option, self)
+                        if option in shortcuts:
+                            action.setShortcut(shortcuts[option])
                         action.triggered.connect(lambda connect, s=[menuName, option]: self.ButtonFunc(s))
                         menu.addAction(action)
+                        self.optionActions[option] = action
                 else: # the option is None (separator)
                     menu.addSeparator()
     
@@ -69,3 +82,12 @@ class MenuBar(qtw.QMenuBar):
         
         elif button[0:2] == ["File", "Export"]:
             self.mainApplication.ExportFile(button[2])
+        
+        elif button == ["Edit", "Undo"]: # reverting the last edit
+            self.mainApplication.Undo()
+        
+        elif button == ["Edit", "Redo"]: # reapplying the last undone edit
+            self.mainApplication.Redo()
+        
+        elif button[0] == "Tools": # optimizing the project
+            self.mainApplication.OptimizeProject(button[1])
@@ -4,6 +4,9 @@ from PyQt6 import QtWidgets as qtw, QtGui as qtg, QtCore as qtc
 # custom data formats
 from utils import data
 
+# for journaling edits
+from utils import history
+
 # for common gui items
 from . import common
 
@@ -79,7 +82,7 @@ class ColorPanel(qtw.QWidget):
 class PaletteVisual(qtw.QLabel):
     """ Visualization of a palette. """
     # signal for change in palette
-    paletteChange = qtc.pyqtSignal()
+    paletteChange = qtc.pyqtSignal(int) # index of the changed palette
 
     def __init__(self, scale: int, mainApplication: object, paletteNum: int):
         super().__init__()
@@ -112,9 +115,13 @@ class PaletteVisual(qtw.QLabel):
             clickPos = event.position().toPoint()
             x = clickPos.x() // self.scale
 
-            # set the current color
+            # set the current color and journal the change as one edit
             color = data.Color(self.currentColor.red(), self.currentColor.green(), self.currentColor.blue())
-            self.mainApplication.projectData.palettes[self.paletteNum].AddColor(color, x)
+            palette = self.mainApplication.projectData.palettes[self.paletteNum]
+            self.mainApplication.history.Record("palette", self.paletteNum * 16 + x, history.PackColor(palette.GetColor(x)), history.PackColor(color))
+            self.mainApplication.EndStroke()
+            palette.AddColor(color, x)
+            self.mainApplication.atlas.InvalidatePalette(self.paletteNum)
             # draw the color
             painter = qtg.QPainter(self.img)
             painter.setBrush(qtg.QBrush(self.currentColor))
@@ -123,7 +130,7 @@ class PaletteVisual(qtw.QLabel):
             self.update()
 
             # send the palette change signal
-            self.paletteChange.emit()
+            self.paletteChange.emit(self.paletteNum)
     
     def paintEvent(self, event):
         """ Draw the new pixmap. """
@@ -194,3 +201,12 @@ class PaletteEditor(qtw.QWidget):
         layout.addWidget(self.colorPanel)
         layout.addWidget(separator)
         layout.addWidget(self.palettePanel)
+    
+    def ResetImage(self):
+        """ Redraw every panel. """
+        for visual in self.palettePanel.visuals:
+            visual.ResetImage()
+    
+    def PaletteChanged(self, paletteIndex: int, chunkIds: list[int]):
+        """ Redraw what uses a changed palette. """
+        self.palettePanel.visuals[paletteIndex].ResetImage()
@@ -7,6 +7,9 @@ from . import common
 # for custom data types
 from utils import data
 
+# for composing tile images
+from utils import render
+
 # for rounding
 import math
 
@@ -32,12 +35,9 @@ class ChunkPicker(qtw.QGraphicsView):
         self.graphicsScene = qtw.QGraphicsScene()
         self.setScene(self.graphicsScene)
 
-        # define the tile choice img
-        self.img = qtg.QPixmap(8 * self.chunkset.chunkSize, self.chunkset.size * 8 * self.chunkset.chunkSize)
-        self.img.fill(qtg.QColor(0, 0, 0)) # fill with black
-
-        # create the label holding the img
-        self.pixmapItem = self.graphicsScene.addPixmap(self.img)
+        # chunk choice canvas of color indices into every palette
+        self.canvas = common.CanvasItem((8 * self.chunkset.chunkSize, self.chunkset.size * 8 * self.chunkset.chunkSize), mainApplication.atlas.ColorTable())
+        self.graphicsScene.addItem(self.canvas)
 
         # create selection overlay
         self.overlay = qtg.QPixmap(8 * self.chunkset.chunkSize, self.chunkset.size * 8 * self.chunkset.chunkSize)
@@ -51,14 +51,12 @@ class ChunkPicker(qtw.QGraphicsView):
         # always have vertical scroll bar
         self.setVerticalScrollBarPolicy(qtc.Qt.ScrollBarPolicy.ScrollBarAlwaysOn)
 
-        # create image once to edit later
-        width = self.img.width()
-        height = self.img.height()
-        self.image = qtg.QImage(width, height, qtg.QImage.Format.Format_ARGB32)
-
         # set the scale
         self.resetTransform()
         self.scale(self.imgScale // (8 * self.chunkset.chunkSize), self.imgScale // (8 * self.chunkset.chunkSize))
+
+        # chunks edited while the image is rendered in the background
+        self.staleChunks = set()
     
     def mousePressEvent(self, event):
         """ Get tile at click event. """
@@ -68,6 +66,9 @@ class ChunkPicker(qtw.QGraphicsView):
         # select
         self.DrawSelect(y)
 
+        # show how many map cells use the chunk
+        self.setToolTip(f"Chunk {y}: used {self.mainApplication.projectData.tilemap.ChunkUsage(y)} times in the tilemap")
+
         # emit color signal
         self.selectedChunk.emit(y)
     
@@ -87,64 +88,49 @@ class ChunkPicker(qtw.QGraphicsView):
 
         # redraw the image
         self.ResetImage()
+    
+    def RefreshChunks(self, chunkIds: list[int]):
+        """ Redraw only the changed chunks. """
+        chunkIds = numpy.asarray(chunkIds, dtype=numpy.intp)
+        if not len(chunkIds):
+            return
+
+        # the image being rendered in the background might miss them
+        if self.canvas.Rendering():
+            self.staleChunks.update(chunkIds.tolist())
+
+        # render the chunks from the shared tile atlas and apply the flips
+        chunks = render.RenderChunks(self.mainApplication.atlas, self.chunkset, chunkIds)
+        chunks = render.FlipImages(chunks, numpy.array((self.currentVFlip << 1) | self.currentHFlip))
+
+        # blit them into their slots on the canvas
+        size = 8 * self.chunkset.chunkSize
+        self.canvas.array.reshape(-1, size, size)[chunkIds] = chunks
+        self.canvas.update()
+    
+    def RefreshPalette(self):
+        """ Recolor the image after a palette changed. """
+        self.canvas.SetColorTable(self.mainApplication.atlas.ColorTable())
 
     def ResetImage(self):
-        """ Redraw the image. """
-        # create blank image
-        width = self.img.width()
-        height = self.img.height()
-
-        # get data
-        palettes = self.mainApplication.projectData.palettes
-        tileset = self.mainApplication.projectData.tileset.set[:]
-        chunkset = self.mainApplication.projectData.chunkset.set[:]
-
-        # convert palette to 32bit ARGB (Alpha, Red, Green, Blue)
-        npPalettes = [numpy.array([
-            # 1st color in palette is transparent
-            ((0x00 if i == 0 else 0xFF) << 24) | (c.red << 16) | (c.green << 8) | c.blue
-            for i, c in enumerate(pal.palette)
-        ], dtype=numpy.uint32) for pal in palettes]
-
-        # access raw image buffer
-        pointer = self.image.bits()
-        pointer.setsize(width * height * 4)
-        imageArray = numpy.ndarray((height, width), dtype=numpy.uint32, buffer=pointer)
-
-        # draw tiles into the numpy buffer
-        for i, c in enumerate(chunkset):
-            chunk = c[:] # fixes reference problems
-
-            # apply flips based on flags
-            if self.currentHFlip:
-                for row in range(self.chunkset.chunkSize):
-                    chunk[row] = chunk[row][::-1] # flip each row within the chunk
-            if self.currentVFlip:
-                chunk = chunk[::-1] # flip the chunk data horizontally
-
-            # add each tile
-            for y in range(self.chunkset.chunkSize):
-                for x in range(self.chunkset.chunkSize):
-                    # get the tile as an object
-                    tileObject = chunk[y][x]
-
-                    # create 2d array for tile
-                    tile = tileset[tileObject.id]
-                    tileData = npPalettes[tileObject.palette][numpy.array(tile, dtype=numpy.uint8)]
-
-                    # apply flips based on flags
-                    if tileObject.hFlip:
-                        for row in range(8):
-                            tileData[row] = tileData[row][::-1] # flip each row within the tile
-                    if tileObject.vFlip:
-                        tileData = tileData[::-1] # flip the tile data horizontally
-
-                    tileX, tileY = x * 8, (y * 8) + (i * 8 * self.chunkset.chunkSize)
-
-                    imageArray[tileY:tileY+8, tileX:tileX+8] = tileData
+        """ Redraw the image in the background. """
+        atlas, chunkset = self.mainApplication.atlas, self.chunkset
+        flips = numpy.array((self.currentVFlip << 1) | self.currentHFlip)
+        width, height = self.canvas.width(), self.canvas.height()
+
+        def Render() -> numpy.ndarray:
+            # render every chunk from the shared tile atlas, apply the flips and stack them
+            chunks = render.RenderChunks(atlas, chunkset)
+            return render.FlipImages(chunks, flips).reshape(height, width)
         
-        self.img = qtg.QPixmap.fromImage(self.image)
-        self.pixmapItem.setPixmap(self.img)
+        self.staleChunks.clear()
+        self.canvas.SetColorTable(atlas.ColorTable())
+        self.canvas.RenderInBackground(Render, self.ImageRendered)
+    
+    def ImageRendered(self):
+        """ Redraw the chunks edited while the image was rendered in the background. """
+        chunkIds, self.staleChunks = sorted(self.staleChunks), set()
+        self.RefreshChunks(chunkIds)
 
 class ChunkPanel(qtw.QWidget):
     """ Panel to select chunk and chunk properties. """
@@ -247,17 +233,21 @@ class TilemapPanel(qtw.QGraphicsView):
         self.graphicsScene = qtw.QGraphicsScene()
         self.setScene(self.graphicsScene)
 
-        # pixmap
-        self.pixmap = qtg.QPixmap(self.mapSize[0] * self.chunkset.chunkSize * 8, self.mapSize[1] * self.chunkset.chunkSize * 8)
-        self.pixmap.fill(qtg.QColor(0, 0, 0, 0))
-        self.pixmapItem = self.graphicsScene.addPixmap(self.pixmap)
+        # every chunk rendered at full size and at the smaller sizes used when zoomed out
+        self.chunkMips = render.ChunkMips(mainApplication.atlas, self.chunkset)
+
+        # canvas split into blocks of whole chunks (about 256x256 pixels) that are only rendered while visible
+        chunkPixels = self.chunkset.chunkSize * 8
+        self.blockChunks = max(1, 256 // chunkPixels)
+        self.canvas = common.TiledCanvasItem((self.mapSize[0] * chunkPixels, self.mapSize[1] * chunkPixels), self.blockChunks * chunkPixels, self.RenderBlock, mainApplication.atlas.ColorTable())
+        self.graphicsScene.addItem(self.canvas)
 
-        # draw a grid ontop of the pixmap
-        self.graphicsScene.addItem(common.GridOverlay((self.pixmap.width(), self.pixmap.height()), 8 * self.chunkset.chunkSize))
+        # draw a grid ontop of the canvas
+        self.graphicsScene.addItem(common.GridOverlay((self.canvas.width(), self.canvas.height()), 8 * self.chunkset.chunkSize))
 
-        # set scroll area and center
-        self.setSceneRect(-5000, -5000, 10000, 10000)
-        self.centerOn(self.pixmapItem)
+        # set scroll area (with room to scroll past every edge of large maps) and center
+        self.setSceneRect(self.canvas.boundingRect().adjusted(-5000, -5000, 5000, 5000).united(qtc.QRectF(-5000, -5000, 10000, 10000)))
+        self.centerOn(self.canvas)
 
         # for zoom/scroll
         self._lastPos = qtc.QPoint()
@@ -300,6 +290,12 @@ class TilemapPanel(qtw.QGraphicsView):
         if event.buttons() & qtc.Qt.MouseButton.LeftButton:
             self.DrawChunks(event) # draw colors
     
+    def mouseReleaseEvent(self, event):
+        """ When the mouse is let go. """
+        # the stroke is one edit in the journal
+        if event.button() == qtc.Qt.MouseButton.LeftButton:
+            self.mainApplication.EndStroke()
+    
     def wheelEvent(self, event):
         """ When the mouse is scrolled. """
         # get scroll amount
@@ -330,141 +326,77 @@ class TilemapPanel(qtw.QGraphicsView):
     
     def DrawChunks(self, event: qtg.QMouseEvent):
         """ Draw tiles at event location. """
-        # get the coords within the pixmap
+        # get the coords within the canvas
         coords = (
-            math.floor(self.pixmapItem.mapFromScene(self.mapToScene(event.position().toPoint())).x()),
-            math.floor(self.pixmapItem.mapFromScene(self.mapToScene(event.position().toPoint())).y())
+            math.floor(self.canvas.mapFromScene(self.mapToScene(event.position().toPoint())).x()),
+            math.floor(self.canvas.mapFromScene(self.mapToScene(event.position().toPoint())).y())
         )
 
         # check if out of range
-        if not (0 <= coords[0] < self.pixmap.width() and 0 <= coords[1] < self.pixmap.height()):
+        if not (0 <= coords[0] < self.canvas.width() and 0 <= coords[1] < self.canvas.height()):
             return
         
         # get coords within tilemap
         withinX = coords[0] // (8 * self.chunkset.chunkSize)
         withinY = coords[1] // (8 * self.chunkset.chunkSize)
 
-        # apply to tilemap
-        self.mainApplication.projectData.tilemap.map[withinY][withinX] = data.Chunk(self.currentChunkIndex, self.currentHFlip, self.currentVFlip)
+        # apply to tilemap and journal the change
+        tilemap = self.mainApplication.projectData.tilemap
+        chunk = data.Chunk(self.currentChunkIndex, self.currentHFlip, self.currentVFlip)
+        self.mainApplication.history.Record("tilemap", withinY * tilemap.size[0] + withinX, tilemap.map[withinY, withinX], chunk.Pack())
+        tilemap.SetChunk(withinX, withinY, chunk)
         
-        # get the chunk data
-        chunkArray = self.mainApplication.projectData.chunkset.set[self.currentChunkIndex][:]
-
-        # apply flips
-        if self.currentHFlip:
-            for y in range(self.chunkset.chunkSize):
-                chunkArray[y] = chunkArray[y][::-1]
-        if self.currentVFlip:
-            chunkArray = chunkArray[::-1]
-
-        # create pixmap image
-        pixmapImage = self.pixmap.toImage()
-
-        # get data
-        palettes = self.mainApplication.projectData.palettes
-        tileset = self.mainApplication.projectData.tileset.set[:]
-
-        # convert palette to 32bit ARGB (Alpha, Red, Green, Blue)
-        npPalettes = [numpy.array([
-            # 1st color in palette is transparent
-            ((0x00 if i == 0 else 0xFF) << 24) | (c.red << 16) | (c.green << 8) | c.blue
-            for i, c in enumerate(pal.palette)
-        ], dtype=numpy.uint32) for pal in palettes]
-
-        # access raw image buffer
-        pointer = pixmapImage.bits()
-        pointer.setsize(self.pixmap.width() * self.pixmap.height() * 4)
-        imageArray = numpy.ndarray((self.pixmap.height(), self.pixmap.width()), dtype=numpy.uint32, buffer=pointer)
-
-        # add each tile
-        for y in range(self.chunkset.chunkSize):
-            for x in range(self.chunkset.chunkSize):
-                # get the tile as an object
-                tileObject = chunkArray[y][x]
-
-                # create 2d array for tile
-                tile = tileset[tileObject.id]
-                tileData = npPalettes[tileObject.palette][numpy.array(tile, dtype=numpy.uint8)]
-
-                # apply flips based on flags
-                if tileObject.hFlip:
-                    for row in range(8):
-                        tileData[row] = tileData[row][::-1] # flip each row within the tile
-                if tileObject.vFlip:
-                    tileData = tileData[::-1] # flip the tile data horizontally
-
-                # get coords of tile
-                tileX = x * 8 + ((coords[0] // (self.chunkset.chunkSize * 8)) * (self.chunkset.chunkSize * 8))
-                tileY = y * 8 + ((coords[1] // (self.chunkset.chunkSize * 8)) * (self.chunkset.chunkSize * 8))
-
-                # draw the tile
-                imageArray[tileY:tileY+8, tileX:tileX+8] = tileData
-
-        # convert back to pixmap and update pixmap item
-        self.pixmap = qtg.QPixmap.fromImage(pixmapImage)
-        self.pixmapItem.setPixmap(self.pixmap)
+        # render the chunk with its flips
+        chunkImage = render.RenderChunks(self.mainApplication.atlas, self.chunkset, [self.currentChunkIndex])
+        chunkImage = render.FlipImages(chunkImage[0], numpy.array((self.currentVFlip << 1) | self.currentHFlip))
+
+        # draw the chunk straight into the canvas
+        self.canvas.Blit(withinX * chunkImage.shape[1], withinY * chunkImage.shape[0], chunkImage)
+    
+    def RefreshChunks(self, chunkIds: list[int]):
+        """ Redraw only the map cells that use the changed chunks. """
+        # the chunks need to be rendered again at every size
+        self.chunkMips.InvalidateChunks(chunkIds)
+
+        # find every cell that depends on the chunks
+        tilemap = self.mainApplication.projectData.tilemap
+        cellsY, cellsX = tilemap.CellsUsingChunks(chunkIds)
+        if not len(cellsY):
+            return
+
+        # render the blocks holding those cells again when they are next shown
+        self.canvas.InvalidateBlocks(self.BlocksOfCells(cellsX, cellsY))
     
+    def RefreshCells(self, cellsX: numpy.ndarray, cellsY: numpy.ndarray):
+        """ Redraw only the changed map cells. """
+        self.canvas.InvalidateBlocks(self.BlocksOfCells(cellsX, cellsY))
+    
+    def RefreshPalette(self, chunkIds: list[int]):
+        """ Recolor the map after a palette used by some chunks changed. """
+        # full size blocks only need their colors swapped
+        self.canvas.SetColorTable(self.mainApplication.atlas.ColorTable())
+
+        # zoomed out blocks have their colors baked in, so the chunks need to be shrunk again
+        self.chunkMips.InvalidateChunks(chunkIds)
+        cellsY, cellsX = self.mainApplication.projectData.tilemap.CellsUsingChunks(chunkIds)
+        if len(cellsY):
+            self.canvas.InvalidateBlocks(self.BlocksOfCells(cellsX, cellsY), minLevel=1)
+    
+    def BlocksOfCells(self, cellsX: numpy.ndarray, cellsY: numpy.ndarray) -> list[tuple[int, int]]:
+        """ Get the full size blocks holding map cells. """
+        blocks = numpy.unique(numpy.stack((cellsX // self.blockChunks, cellsY // self.blockChunks), axis=1), axis=0)
+        return [tuple(block) for block in blocks.tolist()]
+    
+    def RenderBlock(self, rect: qtc.QRect, level: int) -> numpy.ndarray:
+        """ Render the part of the map inside a rect of the canvas, shrunk 2**level times. """
+        return render.RenderMapRect(self.chunkMips, self.mainApplication.projectData.tilemap.map, (rect.x(), rect.y(), rect.width(), rect.height()), level)
+
     def ResetImage(self):
         """ Redraw the image. """
-        # create blank image
-        width = self.pixmap.width()
-        height = self.pixmap.height()
-        image = qtg.QImage(width, height, qtg.QImage.Format.Format_ARGB32)
-
-        # grab palette/tileset/chunkset/tilemap data
-        palettes = self.mainApplication.projectData.palettes
-        tileset = self.mainApplication.projectData.tileset.set
-        chunkset = self.mainApplication.projectData.chunkset.set
-        tilemap = self.mainApplication.projectData.tilemap.map
-
-        # convert palettes to 32bit ARGB (Alpha, Red, Green, Blue)
-        npPalettes = [numpy.array([
-            # 1st color in palette is transparent
-            ((0x00 if i == 0 else 0xFF) << 24) | (c.red << 16) | (c.green << 8) | c.blue
-            for i, c in enumerate(pal.palette)
-        ], dtype=numpy.uint32) for pal in palettes]
-
-        # access raw image buffer
-        pointer = image.bits()
-        pointer.setsize(width * height * 4)
-        imageArray = numpy.ndarray((height, width), dtype=numpy.uint32, buffer=pointer)
-
-        for chunkY in range(self.mapSize[1]):
-            for chunkX in range(self.mapSize[0]):
-                # get chunk data
-                chunkObject = tilemap[chunkY][chunkX]
-                chunkArray = chunkset[chunkObject.id][:]
-
-                # apply flips
-                if chunkObject.hFlip:
-                    for y in range(self.chunkset.chunkSize):
-                        chunkArray[y] = chunkArray[y][::-1]
-                if chunkObject.vFlip:
-                    chunkArray = chunkArray[::-1]
-                
-                # add each tile
-                for y in range(self.chunkset.chunkSize):
-                    for x in range(self.chunkset.chunkSize):
-                        # get the tile as an object
-                        tileObject = chunkArray[y][x]
-
-                        # create 2d array for tile
-                        tile = tileset[tileObject.id]
-                        tileData = npPalettes[tileObject.palette][numpy.array(tile, dtype=numpy.uint8)]
-
-                        # apply flips based on flags
-                        if tileObject.hFlip:
-                            for row in range(8):
-                                tileData[row] = tileData[row][::-1] # flip each row within the tile
-                        if tileObject.vFlip:
-                            tileData = tileData[::-1] # flip the tile data horizontally
-
-                        tileX, tileY = (chunkX * self.chunkset.chunkSize * 8) + (x * 8), (chunkY * self.chunkset.chunkSize * 8) + (y * 8)
-                        imageArray[tileY:tileY+8, tileX:tileX+8] = tileData
-        
-        # convert image to pixmap and apply
-        self.pixmap = qtg.QPixmap.fromImage(image)
-        self.pixmapItem.setPixmap(self.pixmap)
+        # every chunk and block is rendered again when it is next shown
+        self.chunkMips.InvalidateChunks()
+        self.canvas.InvalidateBlocks()
+        self.canvas.SetColorTable(self.mainApplication.atlas.ColorTable())
 
 class TilemapEditor(qtw.QWidget):
     """ Editor menu allowing you to edit the project's tileset. """
@@ -492,3 +424,26 @@ class TilemapEditor(qtw.QWidget):
         layout.addWidget(self.chunkPanel)
         layout.addWidget(separator)
         layout.addWidget(self.tilemapPanel)
+    
+    def ResetImage(self):
+        """ Redraw every panel. """
+        self.chunkPanel.picker.ResetImage()
+        self.tilemapPanel.ResetImage()
+    
+    def PaletteChanged(self, paletteIndex: int, chunkIds: list[int]):
+        """ Redraw what uses a changed palette. """
+        self.chunkPanel.picker.RefreshPalette()
+        self.tilemapPanel.RefreshPalette(chunkIds)
+    
+    def TilesChanged(self, tileIds: list[int], chunkIds: list[int]):
+        """ Redraw what uses changed tiles. """
+        self.ChunksChanged(chunkIds)
+    
+    def ChunksChanged(self, chunkIds: list[int]):
+        """ Redraw what uses changed chunks. """
+        self.chunkPanel.picker.RefreshChunks(chunkIds)
+        self.tilemapPanel.RefreshChunks(chunkIds)
+    
+    def CellsChanged(self, cellsX: numpy.ndarray, cellsY: numpy.ndarray):
+        """ Redraw changed map cells. """
+        self.tilemapPanel.RefreshCells(cellsX, cellsY)
@@ -4,6 +4,9 @@ from PyQt6 import QtWidgets as qtw, QtGui as qtg, QtCore as qtc
 # for common gui items
 from . import common
 
+# for composing tile images
+from utils import render
+
 # for rounding
 import math
 
@@ -101,7 +104,7 @@ class ColorPanel(qtw.QWidget):
 class TilesetPanel(qtw.QGraphicsView):
     """ Panel allowing you to edit tilemaps. """
     # signal for change in tile
-    tileChange = qtc.pyqtSignal()
+    tileChange = qtc.pyqtSignal(list) # ids of the changed tiles
 
     def __init__(self, mainApplication: object):
         super().__init__()
@@ -114,17 +117,16 @@ class TilesetPanel(qtw.QGraphicsView):
         self.graphicsScene = qtw.QGraphicsScene()
         self.setScene(self.graphicsScene)
 
-        # pixmap
-        self.pixmap = qtg.QPixmap(32 * 8, 64 * 8)
-        self.pixmap.fill(qtg.QColor(0, 0, 0, 0))
-        self.pixmapItem = self.graphicsScene.addPixmap(self.pixmap)
+        # canvas of color indices within the current palette, edited in place
+        self.canvas = common.CanvasItem((32 * 8, 64 * 8), mainApplication.atlas.ColorTable(0))
+        self.graphicsScene.addItem(self.canvas)
 
-        # draw a grid ontop of the pixmap
-        self.graphicsScene.addItem(common.GridOverlay((self.pixmap.width(), self.pixmap.height()), 8))
+        # draw a grid ontop of the canvas
+        self.graphicsScene.addItem(common.GridOverlay((self.canvas.width(), self.canvas.height()), 8))
 
         # set scroll area and center
         self.setSceneRect(-5000, -5000, 10000, 10000)
-        self.centerOn(self.pixmapItem)
+        self.centerOn(self.canvas)
 
         # for zoom/scroll
         self._lastPos = qtc.QPoint()
@@ -139,6 +141,9 @@ class TilesetPanel(qtw.QGraphicsView):
         # set palette/color default
         self.currentPaletteIndex = 0
         self.currentColorIndex = 0
+
+        # tiles edited during the current stroke
+        self.changedTiles = set()
     
     def drawBackground(self, painter: qtg.QPainter, rect):
         """ Draws a non-scrolling background. """
@@ -173,9 +178,14 @@ class TilesetPanel(qtw.QGraphicsView):
     
     def mouseReleaseEvent(self, event):
         """ When the mouse is let go. """
-        # send tilechange signal
         if event.button() == qtc.Qt.MouseButton.LeftButton:
-            self.tileChange.emit()
+            # the stroke is one edit in the journal
+            self.mainApplication.EndStroke()
+
+            # send tilechange signal with every tile edited during the stroke
+            if self.changedTiles:
+                self.tileChange.emit(sorted(self.changedTiles))
+                self.changedTiles.clear()
     
     def wheelEvent(self, event):
         """ When the mouse is scrolled. """
@@ -198,30 +208,26 @@ class TilesetPanel(qtw.QGraphicsView):
     
     def SetColor(self, paletteIndex: int, colorIndex: int):
         """ Set the color and the palette. """
-        if self.currentPaletteIndex != paletteIndex: # if new palette redraw the image
+        if self.currentPaletteIndex != paletteIndex: # if new palette recolor the image
             self.currentPaletteIndex = paletteIndex
-            self.ResetImage()
+            self.canvas.SetColorTable(self.mainApplication.atlas.ColorTable(paletteIndex))
         self.currentColorIndex = colorIndex
     
     def DrawPixels(self, event: qtg.QMouseEvent):
         """ Draw pixels at event location. """
-        # get the coords within the pixmap
+        # get the coords within the canvas
         coords = (
-            math.floor(self.pixmapItem.mapFromScene(self.mapToScene(event.position().toPoint())).x()),
-            math.floor(self.pixmapItem.mapFromScene(self.mapToScene(event.position().toPoint())).y())
+            math.floor(self.canvas.mapFromScene(self.mapToScene(event.position().toPoint())).x()),
+            math.floor(self.canvas.mapFromScene(self.mapToScene(event.position().toPoint())).y())
         )
 
         # check if out of range
-        if not (0 <= coords[0] < self.pixmap.width() and 0 <= coords[1] < self.pixmap.height()):
+        if not (0 <= coords[0] < self.canvas.width() and 0 <= coords[1] < self.canvas.height()):
             return
-        
-        # get the color
-        color = self.mainApplication.projectData.palettes[self.currentPaletteIndex].GetColor(self.currentColorIndex)
-        qColor = qtg.QColor(color.red, color.green, color.blue, 255)
 
         # get index in tileset
         tileX, tileY = coords[0] // 8, coords[1] // 8
-        tilesPerRow = self.pixmap.width() // 8
+        tilesPerRow = self.canvas.width() // 8
         tileIndex = (tileY * tilesPerRow) + tileX
 
         if tileIndex + 1 > self.mainApplication.projectData.tileset.size:
@@ -230,59 +236,47 @@ class TilesetPanel(qtw.QGraphicsView):
         # get x/y within tile
         x, y = coords[0] % 8, coords[1] % 8
 
-        # edit the tile
-        self.mainApplication.projectData.tileset.set[tileIndex][y][x] = self.currentColorIndex
+        # edit the tile and journal the change
+        tileset = self.mainApplication.projectData.tileset
+        self.mainApplication.history.Record("tileset", (tileIndex * 8 + y) * 8 + x, tileset.set[tileIndex, y, x], self.currentColorIndex)
+        tileset.set[tileIndex, y, x] = self.currentColorIndex
+        self.mainApplication.atlas.InvalidateTiles([tileIndex])
+        self.changedTiles.add(tileIndex)
+
+        # draw the color straight into the canvas (color 0 is transparent)
+        self.canvas.array[coords[1], coords[0]] = self.currentColorIndex
+        self.canvas.MarkDirty(coords[0], coords[1], 1, 1)
+
+    def RefreshTiles(self, tileIds: list[int]):
+        """ Redraw only the changed tiles. """
+        # only tiles that fit on the sheet are drawn
+        tilesPerRow = self.canvas.width() // 8
+        tileIds = numpy.asarray(tileIds, dtype=numpy.intp)
+        tileIds = tileIds[tileIds < (self.canvas.height() // 8) * tilesPerRow]
+        if not len(tileIds):
+            return
+
+        # blit the tiles pre-rendered as colors within a palette into their slots on the canvas
+        tiles = self.mainApplication.atlas.GetTiles(0)
+        imageArray = self.canvas.array.reshape(self.canvas.height() // 8, 8, tilesPerRow, 8)
+        imageArray[tileIds // tilesPerRow, :, tileIds % tilesPerRow, :] = tiles[tileIds]
+        self.canvas.update()
 
-        # draw the color
-        image = self.pixmap.toImage()
-        if self.currentColorIndex == 0:
-            # if the color is 0 than make transparent
-            image.setPixelColor(coords[0], coords[1], qtg.QColor(0, 0, 0, 0))
-        else:
-            # otherwise painter regular color
-            image.setPixelColor(coords[0], coords[1], qColor)
-        self.pixmap = qtg.QPixmap.fromImage(image)
-        self.pixmapItem.setPixmap(self.pixmap) # update pixmap
+    def RefreshPalette(self, paletteIndex: int):
+        """ Recolor the image if the palette being shown changed. """
+        if paletteIndex == self.currentPaletteIndex:
+            self.canvas.SetColorTable(self.mainApplication.atlas.ColorTable(paletteIndex))
 
     def ResetImage(self):
         """ Redraw the image. """
-        # create blank image
-        width = self.pixmap.width()
-        height = self.pixmap.height()
-        image = qtg.QImage(width, height, qtg.QImage.Format.Format_ARGB32)
-
-        # grab palette/tileset data
-        palette = self.mainApplication.projectData.palettes[self.currentPaletteIndex].palette
-        tileset = self.mainApplication.projectData.tileset.set
-        tilesPerRow = width // 8
-
-        # convert palette to 32bit ARGB (Alpha, Red, Green, Blue)
-        npPalette = numpy.array([
-            # 1st color in palette is transparent
-            ((0x00 if i == 0 else 0xFF) << 24) | (c.red << 16) | (c.green << 8) | c.blue
-            for i, c in enumerate(palette)
-        ], dtype=numpy.uint32)
-
-        # access raw image buffer
-        pointer = image.bits()
-        pointer.setsize(width * height * 4)
-        imageArray = numpy.ndarray((height, width), dtype=numpy.uint32, buffer=pointer)
-
-        # draw tiles into the numpy buffer
-        for tileIndex, tile in enumerate(tileset):
-            # convert tile index into x/y
-            tileX, tileY = (tileIndex % tilesPerRow) * 8, (tileIndex // tilesPerRow) * 8
-
-            # loop for every row in tile
-            for y in range(8):
-                row = tile[y]
-                # loop for every collumn in tile
-                for x in range(8):
-                    imageArray[tileY + y, tileX + x] = npPalette[row[x]]
-        
-        # convert back to pixmap and update pixmap item
-        self.pixmap = qtg.QPixmap.fromImage(image)
-        self.pixmapItem.setPixmap(self.pixmap)
+        # grab the tiles pre-rendered as colors within a palette and lay them out in a grid
+        tiles = self.mainApplication.atlas.GetTiles(0)
+        sheet = render.Sheet(tiles, self.canvas.width() // 8)[:self.canvas.height()]
+
+        # blit the sheet into the canvas (tiles that don't fit are cut off, slots without a tile stay transparent)
+        self.canvas.array[:sheet.shape[0]] = sheet
+        self.canvas.array[sheet.shape[0]:] = 0
+        self.canvas.SetColorTable(self.mainApplication.atlas.ColorTable(self.currentPaletteIndex))
 
 class TilesetEditor(qtw.QWidget):
     """ Editor menu allowing you to edit the project's tileset. """
@@ -309,3 +303,17 @@ class TilesetEditor(qtw.QWidget):
         layout.addWidget(self.colorPanel)
         layout.addWidget(separator)
         layout.addWidget(self.tilesetPanel)
+    
+    def ResetImage(self):
+        """ Redraw every panel. """
+        self.colorPanel.picker.ResetImage()
+        self.tilesetPanel.ResetImage()
+    
+    def PaletteChanged(self, paletteIndex: int, chunkIds: list[int]):
+        """ Redraw what uses a changed palette. """
+        self.colorPanel.picker.ResetImage()
+        self.tilesetPanel.RefreshPalette(paletteIndex)
+    
+    def TilesChanged(self, tileIds: list[int], chunkIds: list[int]):
+        """ Redraw what uses changed tiles. """
+        self.tilesetPanel.RefreshTiles(tileIds)
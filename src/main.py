@@ -6,13 +6,22 @@
 from PyQt6 import QtWidgets as qtw
 
 # command line arguments
+import argparse
 import sys
 
 # main application
 import app
 
+# for the default undo memory limit
+from utils import history
+
 if __name__ == "__main__":
-    main = qtw.QApplication(sys.argv) # create main application instance
-    gui = app.Application() # create gui instance
+    # read our options, qt gets the rest
+    parser = argparse.ArgumentParser(prog="turbulence")
+    parser.add_argument("--undo-memory", type=int, default=history.DEFAULT_MEMORY_LIMIT >> 20, metavar="MB", help="memory the undo journal may use before forgetting the oldest edits (default %(default)s)")
+    args, qtArgs = parser.parse_known_args()
+
+    main = qtw.QApplication(sys.argv[:1] + qtArgs) # create main application instance
+    gui = app.Application(args.undo_memory << 20) # create gui instance
     gui.show() # show the gui
     sys.exit(main.exec()) # exit the application
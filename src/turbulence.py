@@ -0,0 +1,266 @@
+# Turbulence command line
+# converts assets without starting the gui (never imports PyQt6)
+
+# command line arguments
+import argparse
+import sys
+
+# for expanding globs and building output paths
+import glob
+import pathlib
+
+# custom utilities
+from utils import data
+from utils import files
+from utils import optimize
+from utils import project
+
+# file extensions of each input format
+IMAGE_EXTENSIONS = (".png", ".bmp", ".jpg")
+ASM_EXTENSIONS = (".asm", ".s")
+
+# kinds of assets and the formats each one can be written as
+KINDS = ("palettes", "tileset", "chunkset", "tilemap")
+FORMATS = {
+    "palettes": ("asm", "bin", "png"),
+    "tileset": ("asm", "bin", "png", "kos"),
+    "chunkset": ("asm", "bin", "kos"),
+    "tilemap": ("asm", "bin")
+}
+
+def ExpandPaths(patterns: list[str]) -> list[pathlib.Path]:
+    """ Expand glob patterns (for shells that don't) into a sorted list of files. """
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern, recursive=True)) if glob.has_magic(pattern) else [pattern]
+        if not matches:
+            raise FileNotFoundError(f"turbulence: no files match {pattern}")
+        paths += [pathlib.Path(match) for match in matches]
+    return paths
+
+def ReadAsset(kind: str, path: pathlib.Path, chunkSize: int, mapSize: tuple[int, int]) -> object:
+    """ Read one asset from a project, image, assembly, or binary file. """
+    ext = path.suffix.lower()
+
+    # projects hold every kind of asset
+    if ext == ".tge":
+        projectData = project.ReadProjectFile(str(path))
+        return getattr(projectData, kind)
+
+    # images only hold palettes and tilesets
+    if ext in IMAGE_EXTENSIONS:
+        if kind == "palettes":
+            return [files.ExtractPaletteImg(str(path))]
+        if kind == "tileset":
+            return files.ExtractTilesetImg(str(path))
+        raise ValueError(f"turbulence: a {kind} can't be read from an image ({path})")
+
+    # everything else is raw bytes, kosinski compressed bytes, or assembly data
+    if ext in ASM_EXTENSIONS:
+        bin = files.ExtractBinDataAsm(str(path))
+    elif ext == ".kos":
+        bin = files.DecompressKosinski(files.ExtractBytes(str(path)))
+    else:
+        bin = files.ExtractBytes(str(path))
+
+    if kind == "palettes":
+        return files.ExtractPalettesBin(bin)
+    if kind == "tileset":
+        return files.ExtractTilesetBin(bin)
+    if kind == "chunkset":
+        return files.ExtractChunksetBin(bin, chunkSize)
+    return files.ExtractTilemapBin(bin, mapSize)
+
+def WriteAsset(kind: str, asset: object, format: str, path: pathlib.Path, palettes: list[data.Palette] | None=None) -> None:
+    """ Write one asset as an assembly, binary, kosinski compressed, or image file. """
+    if format == "asm":
+        exporters = {"palettes": files.ExportPaletteAsm, "tileset": files.ExportTilesetAsm, "chunkset": files.ExportChunksetAsm, "tilemap": files.ExportTilemapAsm}
+        with open(path, "w") as file:
+            file.write(exporters[kind](asset))
+
+    elif format == "bin":
+        exporters = {"palettes": files.ExportPaletteBin, "tileset": files.ExportTilesetBin, "chunkset": files.ExportChunksetBin, "tilemap": files.ExportTilemapBin}
+        with open(path, "wb") as file:
+            file.write(exporters[kind](asset))
+
+    elif format == "kos":
+        exporters = {"tileset": files.ExportTilesetBin, "chunkset": files.ExportChunksetBin}
+        with open(path, "wb") as file:
+            file.write(files.CompressKosinski(exporters[kind](asset)))
+
+    elif kind == "palettes":
+        # one image per palette
+        for i, palette in enumerate(asset):
+            files.ExportPaletteImg(palette, str(path if len(asset) == 1 else path.with_stem(f"{path.stem}{i}")))
+
+    else:
+        # tiles are drawn with the first palette (or greys when there is none)
+        palette = palettes[0] if palettes else data.Palette([data.Color(i * 17, i * 17, i * 17) for i in range(16)])
+        files.ExportTilesetImg(asset, palette, str(path))
+
+def Convert(args: argparse.Namespace) -> None:
+    """ Convert every input file of one kind of asset to another format. """
+    if args.to not in FORMATS[args.kind]:
+        raise ValueError(f"turbulence: a {args.kind} can't be written as {args.to}")
+
+    # palettes to draw tileset images with
+    palettes = ReadAsset("palettes", pathlib.Path(args.palettes), args.chunk_size, tuple(args.map_size)) if args.palettes else None
+
+    for path in ExpandPaths(args.inputs):
+        asset = ReadAsset(args.kind, path, args.chunk_size, tuple(args.map_size))
+
+        # write next to the input unless an output directory is given
+        outputDir = pathlib.Path(args.output) if args.output else path.parent
+        outputDir.mkdir(parents=True, exist_ok=True)
+        outputPath = outputDir / f"{path.stem}.{args.to}"
+        WriteAsset(args.kind, asset, args.to, outputPath, palettes)
+
+        if not args.quiet:
+            print(f"{path} -> {outputPath}")
+
+def MergeTiles(projectData: project.ProjectData, quiet: bool) -> None:
+    """ Merge duplicate and mirrored tiles of a project, reporting the new count. """
+    before = projectData.tileset.size
+    optimize.MergeTiles(projectData)
+    if not quiet:
+        print(f"merged {before} tiles into {projectData.tileset.size}")
+
+def MergeChunks(projectData: project.ProjectData, quiet: bool) -> None:
+    """ Merge duplicate and mirrored chunks of a project, reporting the new count. """
+    before = projectData.chunkset.size
+    optimize.MergeChunks(projectData)
+    if not quiet:
+        print(f"merged {before} chunks into {projectData.chunkset.size}")
+
+def RemoveUnused(projectData: project.ProjectData, quiet: bool) -> None:
+    """ Drop the tiles and chunks a project never reaches from its tilemap, reporting the savings. """
+    savedBytes = optimize.RemoveUnused(projectData)
+    if not quiet:
+        print(f"kept {projectData.tileset.size} tiles and {projectData.chunkset.size} chunks, saving {savedBytes} bytes")
+
+def Pack(args: argparse.Namespace) -> None:
+    """ Pack assets into a project file (kinds that aren't given keep their defaults). """
+    projectData = project.NewProjectFile()
+
+    # a level image fills every kind, later options replace single kinds
+    if args.level:
+        projectData.palettes, projectData.tileset, projectData.chunkset, projectData.tilemap = files.ExtractLevelImg(args.level, args.chunk_size)
+        if not args.quiet:
+            print(f"{args.level} -> {projectData.tileset.size} tiles, {projectData.chunkset.size} chunks, {projectData.tilemap.size[0]}x{projectData.tilemap.size[1]} map")
+
+    for kind in KINDS:
+        inputPath = getattr(args, kind)
+        if inputPath:
+            asset = ReadAsset(kind, pathlib.Path(inputPath), args.chunk_size, tuple(args.map_size))
+
+            # palettes fill from the first slot, the rest keep their defaults
+            if kind == "palettes":
+                asset = (asset + projectData.palettes[len(asset):])[:len(projectData.palettes)]
+            setattr(projectData, kind, asset)
+
+    # merge repeated and mirrored tiles
+    if args.dedupe_tiles:
+        MergeTiles(projectData, args.quiet)
+
+    project.WriteProjectFile(projectData, args.output)
+    if not args.quiet:
+        print(f"packed {args.output}")
+
+def Unpack(args: argparse.Namespace) -> None:
+    """ Write every asset of project files in one format. """
+    for path in ExpandPaths(args.inputs):
+        projectData = project.ReadProjectFile(str(path))
+
+        # write next to the project unless an output directory is given
+        outputDir = pathlib.Path(args.output) if args.output else path.parent
+        outputDir.mkdir(parents=True, exist_ok=True)
+        for kind in KINDS:
+            if args.to not in FORMATS[kind]:
+                continue
+            outputPath = outputDir / f"{path.stem}_{kind}.{args.to}"
+            WriteAsset(kind, getattr(projectData, kind), args.to, outputPath, projectData.palettes)
+
+            if not args.quiet:
+                print(f"{path} -> {outputPath}")
+
+def Optimize(args: argparse.Namespace) -> None:
+    """ Run optimization passes over project files. """
+    for path in ExpandPaths(args.inputs):
+        projectData = project.ReadProjectFile(str(path))
+
+        # tiles first, so chunks that only differed by duplicate tiles merge too, then drop what merging left unused
+        if args.merge_tiles:
+            MergeTiles(projectData, args.quiet)
+        if args.merge_chunks:
+            MergeChunks(projectData, args.quiet)
+        if args.remove_unused:
+            RemoveUnused(projectData, args.quiet)
+
+        # overwrite the project unless an output directory is given
+        outputDir = pathlib.Path(args.output) if args.output else path.parent
+        outputDir.mkdir(parents=True, exist_ok=True)
+        outputPath = outputDir / path.name
+        project.WriteProjectFile(projectData, str(outputPath))
+
+        if not args.quiet:
+            print(f"{path} -> {outputPath}")
+
+def ParseArgs(argv: list[str]) -> argparse.Namespace:
+    """ Parse the command line. """
+    parser = argparse.ArgumentParser(prog="turbulence", description="Convert Sega Genesis assets without starting the editor.")
+    parser.add_argument("-q", "--quiet", action="store_true", help="don't list the files written")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    # options shared by every command that reads chunksets or tilemaps
+    sizes = argparse.ArgumentParser(add_help=False)
+    sizes.add_argument("--chunk-size", type=int, default=4, help="side length (in tiles) of each chunk (default 4)")
+    sizes.add_argument("--map-size", type=int, nargs=2, default=(64, 32), metavar=("WIDTH", "HEIGHT"), help="size (in chunks) of the tilemap (default 64 32)")
+
+    # convert
+    convert = commands.add_parser("convert", parents=[sizes], help="convert assets of one kind to another format")
+    convert.add_argument("kind", choices=KINDS)
+    convert.add_argument("inputs", nargs="+", help="files or glob patterns (.tge, .asm/.s, .bin, .kos, or .png/.bmp/.jpg)")
+    convert.add_argument("--to", required=True, choices=("asm", "bin", "png", "kos"))
+    convert.add_argument("-o", "--output", help="output directory (default: next to each input)")
+    convert.add_argument("--palettes", help="file to read the palette of tileset images from")
+    convert.set_defaults(func=Convert)
+
+    # pack
+    pack = commands.add_parser("pack", parents=[sizes], help="pack assets into a project file")
+    pack.add_argument("output", help="project file to write (.tge)")
+    for kind in KINDS:
+        pack.add_argument(f"--{kind}", help=f"file to read the {kind} from")
+    pack.add_argument("--level", help="indexed level image to cut into deduplicated tiles, chunks (of --chunk-size) and a tilemap")
+    pack.add_argument("--dedupe-tiles", action="store_true", help="merge duplicate and mirrored tiles (the chunkset is updated to match)")
+    pack.set_defaults(func=Pack)
+
+    # unpack
+    unpack = commands.add_parser("unpack", help="write every asset of project files")
+    unpack.add_argument("inputs", nargs="+", help="project files or glob patterns (.tge)")
+    unpack.add_argument("--to", required=True, choices=("asm", "bin", "png", "kos"))
+    unpack.add_argument("-o", "--output", help="output directory (default: next to each project)")
+    unpack.set_defaults(func=Unpack)
+
+    # optimize
+    optimizeCommand = commands.add_parser("optimize", help="shrink project files")
+    optimizeCommand.add_argument("inputs", nargs="+", help="project files or glob patterns (.tge)")
+    optimizeCommand.add_argument("--merge-tiles", action="store_true", help="merge duplicate and mirrored tiles")
+    optimizeCommand.add_argument("--merge-chunks", action="store_true", help="merge duplicate and mirrored chunks")
+    optimizeCommand.add_argument("--remove-unused", action="store_true", help="drop tiles and chunks the tilemap never reaches, renumbering the rest")
+    optimizeCommand.add_argument("-o", "--output", help="output directory (default: overwrite each project)")
+    optimizeCommand.set_defaults(func=Optimize)
+
+    return parser.parse_args(argv)
+
+def Main(argv: list[str]) -> int:
+    """ Run one command, returning the exit code. """
+    args = ParseArgs(argv)
+    try:
+        args.func(args)
+    except (OSError, ValueError) as error:
+        print(error, file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(Main(sys.argv[1:]))
@@ -1,4 +1,8 @@
 from dataclasses import dataclass
+from collections.abc import Callable
+
+# for contiguous tile storage
+import numpy
 
 @dataclass
 class Color:
@@ -27,15 +31,114 @@ class Palette:
         return self.palette[colorIndex]
 
 class Tileset:
-    """ Set of tiles. """
-    def __init__(self, size: int, set: list[list[list[int]]] | None=None):
+    """ Set of tiles, stored as one contiguous (size, 8, 8) array of color indices. """
+    def __init__(self, size: int, set: numpy.ndarray | list[list[list[int]]] | None=None):
         # define globals
         self.size = size
         # fill with blank tiles to desired size
-        if not set:
-            self.set = [[[0 for x in range(8)] for y in range(8)] for t in range(size)]
+        if set is None:
+            self.set = numpy.zeros((size, 8, 8), dtype=numpy.uint8)
         else:
-            self.set = set
+            # pack nested lists/arrays into a single uint8 block
+            self.set = numpy.ascontiguousarray(set, dtype=numpy.uint8).reshape(size, 8, 8)
+    
+    def GetTile(self, tileIndex: int) -> numpy.ndarray:
+        """ Get an 8x8 view of a specific tile in the tileset. """
+        # return the view (edits write through to the tileset)
+        return self.set[tileIndex]
+
+class UsageIndex:
+    """ Inverted index from ids to the flat positions of every cell that references them.
+        Stored as the cells sorted by id with the offset of each id's run (built on the first query), plus the cells moved since. """
+    # cells moved before the sorted cells are rebuilt
+    MAX_MOVES = 4096
+
+    def __init__(self, readIds: Callable[[], numpy.ndarray]):
+        # define globals
+        self.readIds = readIds # current id of every cell
+        self.builtIds = None # id of every cell when the index was built (None until the first query)
+        self.order = None # cells sorted by id
+        self.starts = None # offset of each id's run of cells in order (one past the largest id at the end)
+        self.moves = {} # cell: id, for cells that changed since the build
+    
+    def Invalidate(self) -> None:
+        """ Forget the index, it is rebuilt on the next query. """
+        self.builtIds = self.order = self.starts = None
+        self.moves = {}
+    
+    def Build(self) -> None:
+        """ Index every cell of the current ids from scratch. """
+        # sort the cells by id and find where each id's run starts
+        self.builtIds = numpy.asarray(self.readIds()).reshape(-1)
+        self.order = numpy.argsort(self.builtIds, kind="stable")
+        self.starts = numpy.concatenate(([0], numpy.cumsum(numpy.bincount(self.builtIds, minlength=1))))
+        self.moves = {}
+    
+    def Move(self, cell: int, oldId: int, newId: int) -> None:
+        """ Record that a cell now references a different id. """
+        # nothing to patch before the first query (the build reads the new ids)
+        if self.builtIds is None or oldId == newId:
+            return
+        
+        # keep small edits on the side, rebuild after many
+        self.moves[cell] = newId
+        if len(self.moves) > self.MAX_MOVES:
+            self.Invalidate()
+    
+    def Moves(self, cells: numpy.ndarray, oldIds: numpy.ndarray, newIds: numpy.ndarray) -> None:
+        """ Record that many cells now reference different ids. """
+        if self.builtIds is None:
+            return
+        changed = oldIds != newIds
+        self.moves.update(zip(numpy.asarray(cells)[changed].tolist(), numpy.asarray(newIds)[changed].tolist()))
+        if len(self.moves) > self.MAX_MOVES:
+            self.Invalidate()
+    
+    def Cells(self, ids: list[int] | numpy.ndarray) -> numpy.ndarray:
+        """ Get the sorted flat positions of every cell that references any of the ids. """
+        if self.builtIds is None:
+            self.Build()
+        ids = numpy.unique(numpy.asarray(ids, dtype=numpy.intp))
+        
+        # gather the runs of every id in one pass
+        indexed = ids[(ids >= 0) & (ids < len(self.starts) - 1)]
+        begins = self.starts[indexed]
+        lengths = self.starts[indexed + 1] - begins
+        runOffsets = numpy.repeat(begins - (numpy.cumsum(lengths) - lengths), lengths)
+        cells = self.order[runOffsets + numpy.arange(lengths.sum())]
+        
+        # swap in the cells moved since the build
+        if self.moves:
+            movedCells = numpy.fromiter(self.moves.keys(), dtype=numpy.intp, count=len(self.moves))
+            movedIds = numpy.fromiter(self.moves.values(), dtype=numpy.intp, count=len(self.moves))
+            cells = numpy.concatenate((cells[~numpy.isin(cells, movedCells)], movedCells[numpy.isin(movedIds, ids)]))
+        
+        # every cell is in one run at most, so sorting is enough
+        return numpy.sort(cells)
+    
+    def Count(self, id: int) -> int:
+        """ Get how many cells reference an id. """
+        if self.builtIds is None:
+            self.Build()
+        id = int(id)
+        count = int(self.starts[id + 1] - self.starts[id]) if 0 <= id < len(self.starts) - 1 else 0
+        
+        # moved cells leave the id they were built with and join their new one
+        for cell, newId in self.moves.items():
+            count += int(newId == id) - int(self.builtIds[cell] == id)
+        return count
+
+# nametable word layout of a tile reference: PCCV HIII IIII IIII
+TILE_PRIORITY = 0x8000 # P: priority
+TILE_PALETTE = 0x6000 # C: palette line
+TILE_VFLIP = 0x1000 # V: vertical flip
+TILE_HFLIP = 0x0800 # H: horizontal flip
+TILE_ID = 0x07FF # I: tile index
+
+# tilemap word layout of a chunk reference: HVII IIII IIII IIII
+CHUNK_HFLIP = 0x8000 # H: horizontal flip
+CHUNK_VFLIP = 0x4000 # V: vertical flip
+CHUNK_ID = 0x3FFF # I: chunk index
 
 @dataclass
 class Tile:
@@ -46,18 +149,79 @@ class Tile:
     hFlip: bool=False
     vFlip: bool=False
 
+    def Pack(self) -> int:
+        """ Pack the tile reference into a nametable word. """
+        return (self.priority << 15) | (self.palette << 13) | (self.vFlip << 12) | (self.hFlip << 11) | self.id
+
+    @classmethod
+    def Unpack(cls, word: int) -> "Tile":
+        """ Unpack a tile reference from a nametable word. """
+        word = int(word)
+        return cls(
+            palette=(word & TILE_PALETTE) >> 13,
+            id=word & TILE_ID,
+            priority=bool(word & TILE_PRIORITY),
+            hFlip=bool(word & TILE_HFLIP),
+            vFlip=bool(word & TILE_VFLIP)
+        )
+
 class Chunkset:
-    """ Set of chunks. """
-    def __init__(self, size: int, chunkSize: int, set: list[list[list[Tile]]] | None=None):
+    """ Set of chunks, stored as one (size, chunkSize, chunkSize) array of nametable words. """
+    def __init__(self, size: int, chunkSize: int, set: numpy.ndarray | list[list[list[int]]] | None=None):
         # define globals
         self.size = size
         self.chunkSize = chunkSize
 
         # fill with blank chunks to desired size
-        if not set:
-            self.set = [[[Tile(palette=0, id=0) for x in range(chunkSize)] for y in range(chunkSize)] for t in range(size)]
+        if set is None:
+            self.set = numpy.zeros((size, chunkSize, chunkSize), dtype=numpy.uint16)
         else:
-            self.set = set
+            # pack nested lists/arrays into a single uint16 block
+            self.set = numpy.ascontiguousarray(set, dtype=numpy.uint16).reshape(size, chunkSize, chunkSize)
+        
+        # index which chunk cells use each tile (built when first needed)
+        self.tileUses = UsageIndex(lambda: TileIds(self.set))
+    
+    def GetChunk(self, chunkIndex: int) -> numpy.ndarray:
+        """ Get a view of the nametable words of a specific chunk. """
+        # return the view (edits write through to the chunkset)
+        return self.set[chunkIndex]
+    
+    def GetTile(self, chunkIndex: int, x: int, y: int) -> Tile:
+        """ Get the tile reference at x/y within a chunk. """
+        return Tile.Unpack(self.set[chunkIndex, y, x])
+    
+    def SetTile(self, chunkIndex: int, x: int, y: int, tile: Tile) -> None:
+        """ Set the tile reference at x/y within a chunk. """
+        cell = (chunkIndex * self.chunkSize + y) * self.chunkSize + x
+        self.tileUses.Move(cell, int(self.set[chunkIndex, y, x]) & TILE_ID, tile.id)
+        self.set[chunkIndex, y, x] = tile.Pack()
+    
+    def SetWords(self, cells: numpy.ndarray, words: numpy.ndarray) -> None:
+        """ Set the nametable words of flat chunk cells. """
+        flat = self.set.reshape(-1)
+        self.tileUses.Moves(cells, TileIds(flat[cells]), TileIds(words))
+        flat[cells] = words
+    
+    def Reindex(self) -> None:
+        """ Rebuild the tile usage index (on its next query) after editing the set directly. """
+        self.tileUses.Invalidate()
+    
+    def TileCells(self, tileIds: list[int]) -> tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+        """ Get the chunk/y/x coords of every chunk cell that references any of the tiles. """
+        return numpy.unravel_index(self.tileUses.Cells(tileIds), self.set.shape)
+    
+    def TileUsage(self, tileId: int) -> int:
+        """ Get how many chunk cells reference a tile. """
+        return self.tileUses.Count(tileId)
+    
+    def ChunksUsingTiles(self, tileIds: list[int]) -> numpy.ndarray:
+        """ Get the ids of every chunk that references any of the tiles. """
+        return numpy.unique(self.TileCells(tileIds)[0])
+    
+    def ChunksUsingPalette(self, paletteIndex: int) -> numpy.ndarray:
+        """ Get the ids of every chunk that has a tile in the palette. """
+        return numpy.flatnonzero((TilePalettes(self.set) == paletteIndex).any(axis=(1, 2)))
 
 @dataclass
 class Chunk:
@@ -66,14 +230,79 @@ class Chunk:
     hFlip: bool=False
     vFlip: bool=False
 
+    def Pack(self) -> int:
+        """ Pack the chunk reference into a tilemap word. """
+        return (self.hFlip << 15) | (self.vFlip << 14) | self.id
+
+    @classmethod
+    def Unpack(cls, word: int) -> "Chunk":
+        """ Unpack a chunk reference from a tilemap word. """
+        word = int(word)
+        return cls(
+            id=word & CHUNK_ID,
+            hFlip=bool(word & CHUNK_HFLIP),
+            vFlip=bool(word & CHUNK_VFLIP)
+        )
+
 class Tilemap:
-    """ Map of chunks. """
-    def __init__(self, size: tuple[int, int], map: list[list[Chunk]] | None=None):
+    """ Map of chunks, stored as one (height, width) array of tilemap words. """
+    def __init__(self, size: tuple[int, int], map: numpy.ndarray | list[list[int]] | None=None):
         # define global
         self.size = size
 
         # fill with blank chunks
-        if not map:
-            self.map = [[Chunk(id=0) for x in range(size[0])] for y in range(size[1])]
+        if map is None:
+            self.map = numpy.zeros((size[1], size[0]), dtype=numpy.uint16)
         else:
-            self.map = map
+            # pack nested lists/arrays into a single uint16 block
+            self.map = numpy.ascontiguousarray(map, dtype=numpy.uint16).reshape(size[1], size[0])
+        
+        # index which map cells use each chunk (built when first needed)
+        self.chunkUses = UsageIndex(lambda: ChunkIds(self.map))
+    
+    def GetChunk(self, x: int, y: int) -> Chunk:
+        """ Get the chunk reference at x/y in the tilemap. """
+        return Chunk.Unpack(self.map[y, x])
+    
+    def SetChunk(self, x: int, y: int, chunk: Chunk) -> None:
+        """ Set the chunk reference at x/y in the tilemap. """
+        self.chunkUses.Move(y * self.size[0] + x, int(self.map[y, x]) & CHUNK_ID, chunk.id)
+        self.map[y, x] = chunk.Pack()
+    
+    def SetWords(self, cells: numpy.ndarray, words: numpy.ndarray) -> None:
+        """ Set the tilemap words of flat map cells. """
+        flat = self.map.reshape(-1)
+        self.chunkUses.Moves(cells, ChunkIds(flat[cells]), ChunkIds(words))
+        flat[cells] = words
+    
+    def Reindex(self) -> None:
+        """ Rebuild the chunk usage index (on its next query) after editing the map directly. """
+        self.chunkUses.Invalidate()
+    
+    def ChunkUsage(self, chunkId: int) -> int:
+        """ Get how many map cells reference a chunk. """
+        return self.chunkUses.Count(chunkId)
+    
+    def CellsUsingChunks(self, chunkIds: list[int]) -> tuple[numpy.ndarray, numpy.ndarray]:
+        """ Get the y/x coords of every map cell that references any of the chunks. """
+        return numpy.unravel_index(self.chunkUses.Cells(chunkIds), self.map.shape)
+
+def TileIds(words: numpy.ndarray) -> numpy.ndarray:
+    """ Get the tile indices of an array of nametable words. """
+    return words & TILE_ID
+
+def TilePalettes(words: numpy.ndarray) -> numpy.ndarray:
+    """ Get the palette lines of an array of nametable words. """
+    return (words & TILE_PALETTE) >> 13
+
+def TileFlips(words: numpy.ndarray) -> numpy.ndarray:
+    """ Get the flips of an array of nametable words (bit 0 = horizontal, bit 1 = vertical). """
+    return (words >> 11) & 0b11
+
+def ChunkIds(words: numpy.ndarray) -> numpy.ndarray:
+    """ Get the chunk indices of an array of tilemap words. """
+    return words & CHUNK_ID
+
+def ChunkFlips(words: numpy.ndarray) -> numpy.ndarray:
+    """ Get the flips of an array of tilemap words (bit 0 = horizontal, bit 1 = vertical). """
+    return ((words >> 15) & 0b01) | ((words >> 13) & 0b10)
@@ -1,11 +1,17 @@
-# handle images
-from PIL import Image
-
 # handle application settings
 import json
 
+# for parsing assembly data
+import re
+import struct
+import pathlib
+
+# for bulk tile data manipulation
+import numpy
+
 # use custom data formats
 from . import data
+from . import optimize
 
 def ReadJson(jsonPath: str) -> dict:
     """ Return application settings in json format. """
@@ -31,92 +37,134 @@ def ExtractBytes(filepath: str) -> bytearray:
 
     return filebytes
 
-def ExtractBinDataAsm(filepath: str) -> list[int]:
+# struct format of every data directive's width (big endian, like the 68k)
+ASM_DATA_DIRECTIVES = {
+    "dc": "H", "dc.b": "B", "dc.w": "H", "dc.l": "L",
+    ".byte": "B", ".word": "H", ".long": "L"
+}
+
+# every directive the parser understands
+ASM_DIRECTIVES = {*ASM_DATA_DIRECTIVES, "even", "incbin"}
+
+# strips a comment without breaking quoted strings that contain ;
+ASM_COMMENT = re.compile(r"""^((?:[^;'"]|'[^']*'|"[^"]*")*)""")
+
+# splits operands without breaking quoted strings that contain ,
+ASM_OPERAND = re.compile(r"""'[^']*'|"[^"]*"|[^,]+""")
+
+# splits incbin operands into the (optionally quoted) path and the rest (offset and length)
+ASM_INCBIN = re.compile(r"""^\s*("[^"]*"|'[^']*'|[^,]*?)\s*(?:,(.*))?$""")
+
+def ParseAsmValue(item: str) -> int:
+    """ Convert one assembly number ($hex, 0xhex, %binary or decimal) to an int. """
+    # handle negative numbers
+    sign = 1
+    if item.startswith("-"):
+        sign, item = -1, item[1:].strip()
+    
+    # dispatch on the number prefix
+    if item.startswith("$"):
+        return sign * int(item[1:], 16)
+    elif item.startswith("%"):
+        return sign * int(item[1:], 2)
+    elif item.lower().startswith("0x"):
+        return sign * int(item[2:], 16)
+    return sign * int(item, 10)
+
+def ExtractBinDataAsm(filepath: str) -> bytearray:
     """ Extracts binary data from 68k assembly source text. """
-    # read text file
+    binary = bytearray()
+
+    # stream the file line by line
     with open(filepath, "r") as file:
-        # split into lines
-        asm = file.read().split("\n")
-    
-    binary = []
-
-    # parse lines
-    for line in asm:
-        # remove comments/white space and lowercase the line
-        line = line.split(";")[0].strip().lower()
-
-        byteDefines = ["dc.b ", "dc.w ", "dc.l ", ".byte ", ".word ", ".long "] # list out every way to define bytes
-        if any(item in line for item in byteDefines): # check for byte defines
-            # remove the byte define
-            for item in byteDefines:
-                line = line.replace(item, "")
-            line = line.replace(" ", "") # remove spaces
-
-            # split for every group of bytes defined per line
-            for item in line.split(","):
-                # convert hex to int and add to bytearray
-                if item.startswith("$") or item.startswith("0x"):
-                    # get rid of hex specification sequence
-                    item = item.replace("$", "").replace("0x", "")
+        for lineNumber, line in enumerate(file, 1):
+            # remove comments (full line comments can also start with *)
+            if line.startswith("*"):
+                continue
+            if ";" in line:
+                line = ASM_COMMENT.match(line).group(1)
+
+            # skip labels (anything that isn't a directive starting in the first column or ending in :)
+            tokens = line.split(None, 1)
+            if tokens and (not line[0].isspace() or tokens[0].endswith(":")) and tokens[0].lower() not in ASM_DIRECTIVES:
+                tokens = tokens[1].split(None, 1) if len(tokens) > 1 else []
+            if not tokens:
+                continue
+            
+            # get the directive and its operands
+            directive = tokens[0].lower()
+            operands = tokens[1] if len(tokens) > 1 else ""
+
+            # data defines
+            if directive in ASM_DATA_DIRECTIVES:
+                format = ASM_DATA_DIRECTIVES[directive]
+                mask = (1 << (struct.calcsize(format) * 8)) - 1
+
+                values = []
+                for item in (ASM_OPERAND.findall(operands) if "'" in operands or '"' in operands else operands.split(",")):
+                    item = item.strip()
 
                     # make sure there is actual data
                     if not item:
                         continue
-
-                    # ensure length is multiple of two
-                    if len(item) % 2 == 1:
-                        item = "0" + item
                     
-                    itembytes = [item[i:i+2] for i in range(0, len(item), 2)] # get the bytes for every item
-                    try:
-                        for i in itembytes: # append all the bytes
-                            binary.append(int("0x" + i, 16))
-                    except Exception as error: # couldn't convert to dec: hex in wrong format
-                        raise ValueError(f"utils/files.py: ExtractBinDataAsm: Hexadecimal data not hexadecimal format.") from error
-                
-                # convert bin to int and add to bytearray
-                elif item.startswith("%"):
-                    # get rid of bin specification character
-                    item = item.replace("%", "")
-
-                    # make sure there is actual data
-                    if not item:
+                    # strings define one value per character
+                    if item[0] in "'\"":
+                        values.extend(ord(char) for char in item[1:-1])
                         continue
 
-                    # ensure length is multiple of eight
-                    if len(item) % 8 != 0:
-                        item = (len(item) % 8 * "0") + item
-                    
-                    itembytes = [item[i:i+8] for i in range(0, len(item), 8)] # get the bytes for every item
                     try:
-                        for i in itembytes: # append all the bytes
-                            binary.append(int(i, 2))
-                    except Exception as error: # couldn't convert to dec: binary in wrong format
-                        raise ValueError(f"utils/files.py: ExtractBinDataAsm: Binary data not binary format.") from error
+                        value = ParseAsmValue(item)
+                    except ValueError as error: # not a number we understand
+                        raise ValueError(f"utils/files.py: ExtractBinDataAsm: line {lineNumber}: \"{item}\" is not a number.") from error
+                    
+                    # values must fit the directive's width (signed or unsigned), negatives are stored as two's complement
+                    if not -((mask + 1) >> 1) <= value <= mask:
+                        raise ValueError(f"utils/files.py: ExtractBinDataAsm: line {lineNumber}: \"{item}\" does not fit in {directive}.")
+                    values.append(value & mask)
                 
-                # convert dec to hex and back to dec
-                else:
-                    # make sure there is actual data
-                    if not item:
-                        continue
-
-                    # get the hexadecimal representation
+                # write every value at the directive's width
+                binary += struct.pack(f">{len(values)}{format}", *values)
+            
+            # align to the next word
+            elif directive == "even":
+                if len(binary) % 2:
+                    binary.append(0)
+            
+            # include a binary file (relative to the assembly file)
+            elif directive == "incbin":
+                # the path comes first so commas inside quotes stay part of it
+                path, rest = ASM_INCBIN.match(operands.strip()).groups()
+                if path[:1] in ("'", '"'):
+                    # anything after the closing quote that isn't an operand is a typo
+                    if len(path) < 2 or path[-1] != path[0] or path[0] in path[1:-1]:
+                        raise ValueError(f"utils/files.py: ExtractBinDataAsm: line {lineNumber}: {path} is not a file path.")
+                    path = path[1:-1]
+                if not path:
+                    raise ValueError(f"utils/files.py: ExtractBinDataAsm: line {lineNumber}: incbin needs a file.")
+                include = ExtractBytes(pathlib.Path(filepath).parent / path)
+
+                # optional offset and length into the file
+                values = []
+                for item in (rest.split(",") if rest is not None else []):
+                    item = item.strip()
                     try:
-                        hexVal = hex(int(item)).replace("0x", "")
-                    except Exception as error:
-                        raise ValueError(f"utils/files.py: ExtractBinDataAsm: Decimal data not decimal format.") from error
-                    
-                    # ensure length is multiple of two
-                    if len(hexVal) % 2 == 1:
-                        hexVal = "0" + hexVal
-                    
-                    itembytes = [hexVal[i:i+2] for i in range(0, len(hexVal), 2)] # get the bytes for every item
-                    for i in itembytes: # append all the bytes
-                        binary.append(int("0x" + i, 16))
+                        values.append(ParseAsmValue(item))
+                    except ValueError as error: # not a number we understand
+                        raise ValueError(f"utils/files.py: ExtractBinDataAsm: line {lineNumber}: \"{item}\" is not a number.") from error
+                if len(values) > 2:
+                    raise ValueError(f"utils/files.py: ExtractBinDataAsm: line {lineNumber}: incbin takes a file, an offset and a length, got {len(values) + 1} operands.")
+                
+                # the included range must lie inside the file
+                offset = values[0] if len(values) > 0 else 0
+                length = values[1] if len(values) > 1 else len(include) - offset
+                if not 0 <= offset <= len(include) or not 0 <= length <= len(include) - offset:
+                    raise ValueError(f"utils/files.py: ExtractBinDataAsm: line {lineNumber}: incbin range {offset}+{length} is outside of \"{path}\" ({len(include)} bytes).")
+                binary += include[offset:offset + length]
                     
     return binary
 
-def ExtractPalettesBin(bin: list[int]) -> list[data.Palette]:
+def ExtractPalettesBin(bin: bytes | bytearray | list[int]) -> list[data.Palette]:
     """ Extract palette data from binary byte list. """
     # split into groups of 2 bytes, colors
     genesisColors = [bin[i:i+2] for i in range(0, len(bin), 2)]
@@ -132,62 +180,53 @@ def ExtractPalettesBin(bin: list[int]) -> list[data.Palette]:
     # split into palettes and return
     return [data.Palette(RGBColors[color:color+16]) for color in range(0, len(RGBColors), 16)]
 
-def ExtractTilesetBin(bin: list[int]) -> data.Tileset:
-    """ Extract tileset data from binary byte list. """
+def ExtractTilesetBin(bin: bytes | bytearray | memoryview | list[int]) -> data.Tileset:
+    """ Extract tileset data from 4bpp (4 bits per pixel) binary bytes. """
+    # view the bytes without copying them
+    if isinstance(bin, list):
+        packed = numpy.array(bin, dtype=numpy.uint8)
+    else:
+        packed = numpy.frombuffer(bin, dtype=numpy.uint8)
 
-    # split bin into hex digits
-    binary = [int(f"{hex(bin[i // 2]).replace("0x", ""):0>2}"[i % 2]) for i in range(len(bin) * 2)]
-    
-    # split into tiles
-    genesisTiles = [binary[i:i+64] for i in range(0, len(binary), 64)]
+    # split into whole tiles of 8 rows of 4 bytes
+    numTiles = len(packed) // 32
+    packed = packed[:numTiles * 32].reshape(numTiles, 8, 4)
+
+    # unpack the high (left) and low (right) pixel of every byte
+    pixels = numpy.empty((numTiles, 8, 8), dtype=numpy.uint8)
+    pixels[..., 0::2] = packed >> 4
+    pixels[..., 1::2] = packed & 0x0F
 
-    # split tiles into 2d arrays
-    #                                        get each row of a tile -------------- for every row ---- for every tile    
-    return data.Tileset(len(genesisTiles), [[[tile[(y * 8) + x] for x in range(8)] for y in range(8)] for tile in genesisTiles])
+    return data.Tileset(numTiles, pixels)
 
-def ExtractChunksetBin(bin: list[int], chunkSize: int) -> data.Chunkset:
+def ExtractChunksetBin(bin: bytes | bytearray | list[int], chunkSize: int) -> data.Chunkset:
     """ Extract chunkset data from binary byte list. """
     # get the tiles/bytes per chunk
     tilesPerChunk = (chunkSize * chunkSize)
     
-    # convert data in tiles
-    tiles = []
-    for i in range(0, len(bin), 2):
-        # get all tile data
-        tileData = int.from_bytes(bin[i:i+2], "big")
-        priority = bool((tileData >> 15) & 0b01)
-        palette = (tileData >> 13) & 0b11
-        vFlip = bool((tileData >> 12) & 0b01)
-        hFlip = bool((tileData >> 11) & 0b01)
-        id = tileData & 0b011111111111
-        tiles.append(data.Tile(palette, id, priority, hFlip, vFlip))
-
-    # seperate tiles into chunks
-    chunks = [tiles[i:i+tilesPerChunk] for i in range(0, len(tiles), tilesPerChunk)]
-
-    # convert into 2d arrays and return
-    #                                              get row of chunk ----------------------------------- add each row to chunk ---- for every chunk
-    return data.Chunkset(len(chunks), chunkSize, [[chunk[(y * chunkSize):((y * chunkSize) + chunkSize)] for y in range(chunkSize)] for chunk in chunks])
-
-def ExtractTilemapBin(bin: list[int], size: tuple[int, int]) -> data.Tilemap:
+    # read the big endian nametable words (the layout the chunkset is stored in)
+    words = numpy.frombuffer(bytes(bin[:len(bin) - (len(bin) % 2)]), dtype=">u2")
+
+    # seperate tiles into whole chunks
+    numChunks = len(words) // tilesPerChunk
+    return data.Chunkset(numChunks, chunkSize, words[:numChunks * tilesPerChunk].astype(numpy.uint16))
+
+def ExtractTilemapBin(bin: bytes | bytearray | list[int], size: tuple[int, int]) -> data.Tilemap:
     """ Extract tilemap data from binary byte list. """
-    # convert into chunks
-    chunks = []
-    for i in range(0, len(bin), 2):
-        # get all chunk data
-        chunkData = int.from_bytes(bin[i:i+2], "big")
-        hFlip = bool((chunkData >> 15) & 0b01)
-        vFlip = bool((chunkData >> 15) & 0b01)
-        id = chunkData & 0b0011111111111111
-        chunks.append(data.Chunk(id, hFlip, vFlip))
-
-    # break into 2d array and return
-    #                          get row of tilemap ---------------------------- add each row to tilemap
-    return data.Tilemap(size, [chunks[(y * size[0]):((y * size[0]) + size[0])] for y in range(size[0])])
+    # read the big endian tilemap words
+    words = numpy.frombuffer(bytes(bin[:len(bin) - (len(bin) % 2)]), dtype=">u2")
+
+    # fill the map row by row (missing chunks are left blank) before the tilemap indexes it
+    map = numpy.zeros(size[0] * size[1], dtype=numpy.uint16)
+    count = min(len(words), len(map))
+    map[:count] = words[:count]
+
+    return data.Tilemap(size, map)
 
 def ExtractPaletteImg(imgpath: str) -> data.Palette:
     """ Extract palette data from bitmap image. """
-    # open the image
+    # open the image (pillow is only loaded for images so headless conversions start fast)
+    from PIL import Image
     img = Image.open(imgpath)
     
     # get the palette
@@ -199,21 +238,59 @@ def ExtractPaletteImg(imgpath: str) -> data.Palette:
 def ExtractTilesetImg(imgpath: str) -> data.Tileset:
     """ Extract tileset data from bitmap image. """
     # open the image
+    from PIL import Image
     img = Image.open(imgpath)
     
-    # read image data
+    # read image data as a 2d array of color indices
     sizePixels = img.size
-    sizeTiles = (sizePixels[0] // 8, sizePixels[0] // 8)
+    sizeTiles = (sizePixels[0] // 8, sizePixels[1] // 8)
     numTiles = sizeTiles[0] * sizeTiles[1]
-    pixels = img.getdata()
+    pixels = numpy.asarray(img, dtype=numpy.uint8)
 
-    # convert into list of 8x8 2d arrays - I'm so sorry
-    #          get pixels of row of tile -------------------------------------------------------------------------------------------------------------------------- for each row and tile
-    #                     (tile y * 8) + y = px y  | px y * width  |  tile x * 8 = px x   | do the same thing but add 8 to get full row                         v
-    tiles = [[[pixels[((((tile//sizeTiles[0])*8)+y)*sizePixels[0])+((tile%sizeTiles[0])*8):((((tile//sizeTiles[0])*8)+y)*sizePixels[0])+((tile%sizeTiles[0])*8)+8]] for y in range(8)] for tile in range(numTiles)]
+    # crop to whole tiles, split into (tile row, y, tile column, x) and reorder into a list of 8x8 tiles
+    pixels = pixels[:sizeTiles[1] * 8, :sizeTiles[0] * 8]
+    tiles = pixels.reshape(sizeTiles[1], 8, sizeTiles[0], 8).swapaxes(1, 2).reshape(numTiles, 8, 8)
 
     return data.Tileset(numTiles, tiles)
 
+def ExtractLevelImg(imgpath: str, chunkSize: int) -> tuple[list[data.Palette], data.Tileset, data.Chunkset, data.Tilemap]:
+    """ Extract palettes, deduplicated tiles and chunks, and the tilemap placing them from a whole level image. """
+    # open the image
+    from PIL import Image
+    img = Image.open(imgpath)
+    if img.mode != "P":
+        raise ValueError(f"{imgpath} is not an indexed image")
+
+    # the first 64 colors are the four palette lines
+    palette = (img.getpalette() + [0] * 192)[:192]
+    palettes = [data.Palette([data.Color(*palette[i:i + 3]) for i in range(line * 48, line * 48 + 48, 3)]) for line in range(4)]
+
+    # cut the color indices into tiles, chunks and the tilemap
+    tileset, chunkset, tilemap = optimize.LevelFromImage(numpy.asarray(img, dtype=numpy.uint8), chunkSize)
+    return palettes, tileset, chunkset, tilemap
+
+def ExportPaletteImg(palette: data.Palette, imgpath: str) -> None:
+    """ Export palette as a 16x1 indexed bitmap image (one pixel per color). """
+    from PIL import Image
+    img = Image.frombytes("P", (16, 1), bytes(range(16)))
+    img.putpalette([channel for color in palette.palette for channel in (color.red, color.green, color.blue)])
+    img.save(imgpath)
+
+def ExportTilesetImg(tileset: data.Tileset, palette: data.Palette, imgpath: str, columns: int=16) -> None:
+    """ Export tileset as an indexed bitmap image of tiles laid out in rows. """
+    # pad to whole rows of tiles with blank tiles
+    rows = -(-tileset.size // columns)
+    tiles = numpy.zeros((rows * columns, 8, 8), dtype=numpy.uint8)
+    tiles[:tileset.size] = tileset.set & 0x0F
+
+    # split into (tile row, tile column, y, x) and reorder into rows of pixels
+    pixels = tiles.reshape(rows, columns, 8, 8).swapaxes(1, 2).reshape(rows * 8, columns * 8)
+
+    from PIL import Image
+    img = Image.frombytes("P", (pixels.shape[1], pixels.shape[0]), pixels.tobytes())
+    img.putpalette([channel for color in palette.palette for channel in (color.red, color.green, color.blue)])
+    img.save(imgpath)
+
 def ExportPaletteAsm(palettes: list[data.Palette]) -> str:
     """ Export all palettes as assembly data. """
     # variable holding assembly file data
@@ -222,10 +299,10 @@ def ExportPaletteAsm(palettes: list[data.Palette]) -> str:
         asm += f"Palette{i}:"
 
         for color in palette.palette:
-            # convert the colors to 3 bit
-            red = (color.red * 14) // 255
-            green = (color.green * 14) // 255
-            blue = (color.blue * 14) // 255
+            # convert the colors to 3 bit (in the upper bits of each nibble, the inverse of ExtractPalettesBin)
+            red = ((color.red * 7 + 127) // 255) << 1
+            green = ((color.green * 7 + 127) // 255) << 1
+            blue = ((color.blue * 7 + 127) // 255) << 1
 
             # convert the colors to hexadecimal text and add it to the asm data
             asm += f"\n\tdc.w $0{hex(blue).replace("0x", "")}{hex(green).replace("0x", "")}{hex(red).replace("0x", "")}"
@@ -260,13 +337,8 @@ def ExportChunksetAsm(chunkset: data.Chunkset) -> str:
         asm += "\n"
 
         for row in chunk:
-            asm += "\n\tdc.w "
-            for i, tile in enumerate(row):
-                # convert tile to number data
-                tileNum = (tile.priority << 15) + (tile.palette << 13) + (tile.vFlip << 12) + (tile.hFlip << 11) + tile.id
-
-                # add the tile
-                asm += f"${hex(tileNum).replace("0x", ""):0>4}" + (", " if i + 1 < len(row) else "")
+            # add the row of nametable words
+            asm += "\n\tdc.w " + ", ".join(f"${word:0>4x}" for word in row.tolist())
     
     return asm
 
@@ -275,14 +347,198 @@ def ExportTilemapAsm(tilemap: data.Tilemap) -> str:
     # variable holding assembly file data
     asm = "Tilemap:"
     for row in tilemap.map:
-        # add next row
-        asm += "\n\tdc.w "
-
-        for i, chunk in enumerate(row):
-            # convert tile to number data
-            chunkNum = (chunk.hFlip << 15) + (chunk.vFlip << 13) + chunk.id
-
-            # add the tile
-            asm += f"${hex(chunkNum).replace("0x", ""):0>4}" + (", " if i + 1 < len(row) else "")
+        # add next row of tilemap words
+        asm += "\n\tdc.w " + ", ".join(f"${word:0>4x}" for word in row.tolist())
     
     return asm
+
+def ExportPaletteBin(palettes: list[data.Palette]) -> bytes:
+    """ Export all palettes as binary CRAM (Color RAM) words. """
+    # convert the colors to 3 bit (in the upper bits of each nibble, the inverse of ExtractPalettesBin)
+    colors = numpy.array([[(c.red, c.green, c.blue) for c in palette.palette] for palette in palettes], dtype=numpy.uint16).reshape(-1, 3)
+    colors = ((colors * 7 + 127) // 255) << 1
+
+    # pack into big endian 0BGR words
+    words = (colors[:, 2] << 8) | (colors[:, 1] << 4) | colors[:, 0]
+    return words.astype(">u2").tobytes()
+
+def ExportTilesetBin(tileset: data.Tileset) -> bytes:
+    """ Export tileset as binary 4bpp (4 bits per pixel) tile data. """
+    # pack every pair of pixels into a byte (left pixel in the high nibble)
+    pixels = tileset.set & 0x0F
+    return ((pixels[..., 0::2] << 4) | pixels[..., 1::2]).tobytes()
+
+def ExportChunksetBin(chunkset: data.Chunkset) -> bytes:
+    """ Export chunkset as binary big endian nametable words. """
+    return chunkset.set.astype(">u2").tobytes()
+
+def ExportTilemapBin(tilemap: data.Tilemap) -> bytes:
+    """ Export tilemap as binary big endian tilemap words. """
+    return tilemap.map.astype(">u2").tobytes()
+
+# kosinski match limits
+KOSINSKI_WINDOW = 0x2000 # furthest back a full match can reach
+KOSINSKI_INLINE_WINDOW = 0x100 # furthest back an inline match can reach
+KOSINSKI_INLINE_MAX = 5 # longest inline match
+KOSINSKI_MAX = 0x100 # longest full match
+KOSINSKI_CHAIN_DEPTH = 64 # earlier positions searched per byte
+
+def DecompressKosinski(bin: bytes | bytearray) -> bytearray:
+    """ Decompress Kosinski data (as used by Sonic the Hedgehog games). """
+    out = bytearray()
+    pos = 0
+
+    # descriptor bits are read lsb first, and reloaded as soon as the last one is used
+    descriptor = bin[pos] | (bin[pos + 1] << 8)
+    pos += 2
+    bitsLeft = 16
+
+    def ReadBit() -> int:
+        nonlocal descriptor, bitsLeft, pos
+        bit = descriptor & 1
+        descriptor >>= 1
+        bitsLeft -= 1
+        if not bitsLeft:
+            descriptor = bin[pos] | (bin[pos + 1] << 8)
+            pos += 2
+            bitsLeft = 16
+        return bit
+
+    while True:
+        # 1: literal byte
+        if ReadBit():
+            out.append(bin[pos])
+            pos += 1
+            continue
+
+        if ReadBit():
+            # 01: full match, 13 bit offset and 3 bit count (or a count byte)
+            low, high = bin[pos], bin[pos + 1]
+            pos += 2
+            offset = (0xE000 | ((high & 0xF8) << 5) | low) - 0x10000
+            count = high & 0x07
+            if count:
+                count += 2
+            else:
+                extra = bin[pos]
+                pos += 1
+                if extra == 0: # end of data
+                    break
+                if extra == 1: # no-op
+                    continue
+                count = extra + 1
+        else:
+            # 00: inline match, 2 bit count and 8 bit offset
+            count = ((ReadBit() << 1) | ReadBit()) + 2
+            offset = bin[pos] - 0x100
+            pos += 1
+
+        # copy byte by byte, since the match may overlap what it writes
+        start = len(out) + offset
+        if start < 0:
+            raise ValueError("kosinski data refers back before its start")
+        for i in range(start, start + count):
+            out.append(out[i])
+
+    return out
+
+def CompressKosinski(bin: bytes | bytearray) -> bytes:
+    """ Compress data with Kosinski, finding matches through hash chains of the byte pairs in the window. """
+    bin = bytes(bin)
+    size = len(bin)
+
+    # hash chains: the latest position of each byte pair, and the previous position of the same pair
+    latest = {}
+    previous = [-1] * size
+
+    # output with a reserved descriptor that is filled in as bits are written
+    out = bytearray(2)
+    descriptorPos = 0
+    descriptor = 0
+    bitCount = 0
+
+    def WriteBit(bit: int) -> None:
+        nonlocal descriptor, bitCount, descriptorPos
+        descriptor |= bit << bitCount
+        bitCount += 1
+        if bitCount == 16:
+            # store the full descriptor and reserve the next one right away (where the decompressor reloads it)
+            out[descriptorPos] = descriptor & 0xFF
+            out[descriptorPos + 1] = descriptor >> 8
+            descriptorPos = len(out)
+            out.extend(b"\x00\x00")
+            descriptor = bitCount = 0
+
+    def Insert(pos: int) -> None:
+        if pos + 1 < size:
+            key = bin[pos:pos + 2]
+            previous[pos] = latest.get(key, -1)
+            latest[key] = pos
+
+    pos = 0
+    while pos < size:
+        # walk the chain of earlier positions starting with the same byte pair (nearest first)
+        bestLength = bestOffset = inlineLength = inlineOffset = 0
+        maxLength = min(KOSINSKI_MAX, size - pos)
+        candidate = latest.get(bin[pos:pos + 2], -1) if pos + 1 < size else -1
+        depth = KOSINSKI_CHAIN_DEPTH
+        while candidate >= 0 and pos - candidate <= KOSINSKI_WINDOW and depth:
+            # extend the match (it may run into the bytes being matched)
+            length = 2
+            while length < maxLength and bin[candidate + length] == bin[pos + length]:
+                length += 1
+            if length > bestLength:
+                bestLength, bestOffset = length, pos - candidate
+            if pos - candidate <= KOSINSKI_INLINE_WINDOW and length > inlineLength:
+                inlineLength, inlineOffset = min(length, KOSINSKI_INLINE_MAX), pos - candidate
+            if length == maxLength:
+                break
+            candidate = previous[candidate]
+            depth -= 1
+
+        # bits saved over literals (9 bits each): inline matches cost 12 bits, full ones 18 (26 with a count byte)
+        fullSaving = bestLength * 9 - (18 if bestLength <= 9 else 26) if bestLength >= 3 else 0
+        inlineSaving = inlineLength * 9 - 12 if inlineLength >= 2 else 0
+
+        if inlineSaving > 0 and inlineSaving >= fullSaving:
+            # 00: inline match
+            count = inlineLength
+            WriteBit(0)
+            WriteBit(0)
+            WriteBit((count - 2) >> 1)
+            WriteBit((count - 2) & 1)
+            out.append(0x100 - inlineOffset)
+
+        elif fullSaving > 0:
+            # 01: full match
+            count = bestLength
+            offset = 0x10000 - bestOffset
+            WriteBit(0)
+            WriteBit(1)
+            out.append(offset & 0xFF)
+            if count <= 9:
+                out.append(((offset >> 5) & 0xF8) | (count - 2))
+            else:
+                out.append((offset >> 5) & 0xF8)
+                out.append(count - 1)
+
+        else:
+            # 1: literal byte
+            count = 1
+            WriteBit(1)
+            out.append(bin[pos])
+
+        # add every position covered to the chains
+        for i in range(pos, pos + count):
+            Insert(i)
+        pos += count
+
+    # end of data: a full match with a zero count byte
+    WriteBit(0)
+    WriteBit(1)
+    out.extend(b"\x00\xF0\x00")
+
+    # store the last descriptor
+    out[descriptorPos] = descriptor & 0xFF
+    out[descriptorPos + 1] = descriptor >> 8
+    return bytes(out)
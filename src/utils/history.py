@@ -0,0 +1,126 @@
+from dataclasses import dataclass
+from collections import deque
+
+# for compact delta storage
+import numpy
+
+# for custom data types
+from . import data
+
+# value type of each editable array, indexed by flat cell
+TARGET_DTYPES = {
+    "palette": numpy.uint32, # cell = palette * 16 + color, value = packed rgb
+    "tileset": numpy.uint8, # cell = (tile * 8 + y) * 8 + x, value = color index
+    "chunkset": numpy.uint16, # cell = (chunk * size + y) * size + x, value = nametable word
+    "tilemap": numpy.uint16 # cell = y * width + x, value = tilemap word
+}
+
+# default memory the journal may use before forgetting the oldest edits
+DEFAULT_MEMORY_LIMIT = 32 * 1024 * 1024 # 32MB
+
+def PackColor(color: data.Color) -> int:
+    """ Pack a color into one int (0xRRGGBB). """
+    return (color.red << 16) | (color.green << 8) | color.blue
+
+def UnpackColor(value: int) -> data.Color:
+    """ Unpack a color from one int (0xRRGGBB). """
+    value = int(value)
+    return data.Color((value >> 16) & 0xFF, (value >> 8) & 0xFF, value & 0xFF)
+
+@dataclass
+class Delta:
+    """ One edit of an array, stored as the flat cells it changed with their old and new values. """
+    target: str
+    cells: numpy.ndarray
+    old: numpy.ndarray
+    new: numpy.ndarray
+
+    def Size(self) -> int:
+        """ Get how many bytes the delta uses. """
+        return self.cells.nbytes + self.old.nbytes + self.new.nbytes
+
+class History:
+    """ Journal of edits (one per stroke) that can be undone and redone, bounded by memory. """
+    def __init__(self, memoryLimit: int=DEFAULT_MEMORY_LIMIT):
+        # define globals
+        self.memoryLimit = memoryLimit
+        self.memoryUsed = 0 # bytes used by both stacks
+
+        # deltas from oldest to newest
+        self.undoStack = deque()
+        self.redoStack = deque()
+
+        # stroke being recorded: target and [old, new] by cell
+        self.strokeTarget = None
+        self.strokeCells = {}
+
+    def Record(self, target: str, cell: int, old: int, new: int) -> None:
+        """ Record one cell edited by the current stroke (repeated edits of a cell are merged). """
+        if target != self.strokeTarget:
+            self.EndStroke()
+            self.strokeTarget = target
+
+        # keep the value from before the stroke, update the one after it
+        values = self.strokeCells.get(cell)
+        if values is None:
+            self.strokeCells[cell] = [int(old), int(new)]
+        else:
+            values[1] = int(new)
+
+    def EndStroke(self) -> None:
+        """ Pack the current stroke into a delta and add it to the journal. """
+        target, strokeCells = self.strokeTarget, self.strokeCells
+        self.strokeTarget, self.strokeCells = None, {}
+        if not strokeCells:
+            return
+
+        # pack the cells that actually changed into arrays
+        cells = numpy.fromiter(strokeCells.keys(), dtype=numpy.uint32, count=len(strokeCells))
+        values = numpy.array(list(strokeCells.values()), dtype=TARGET_DTYPES[target]).reshape(-1, 2)
+        changed = values[:, 0] != values[:, 1]
+        if not changed.any():
+            return
+        delta = Delta(target, cells[changed], values[changed, 0], values[changed, 1])
+
+        # a new edit replaces everything that could be redone
+        self.memoryUsed -= sum(redone.Size() for redone in self.redoStack)
+        self.redoStack.clear()
+        self.undoStack.append(delta)
+        self.memoryUsed += delta.Size()
+
+        # forget the oldest edits while over the limit (the newest one is always kept)
+        while self.memoryUsed > self.memoryLimit and len(self.undoStack) > 1:
+            self.memoryUsed -= self.undoStack.popleft().Size()
+
+    def CanUndo(self) -> bool:
+        """ Check if there is an edit to undo. """
+        return bool(self.undoStack or self.strokeCells)
+
+    def CanRedo(self) -> bool:
+        """ Check if there is an edit to redo. """
+        return bool(self.redoStack)
+
+    def Undo(self) -> Delta | None:
+        """ Take the newest edit off the journal, the caller writes back its old values. """
+        self.EndStroke()
+        if not self.undoStack:
+            return None
+        delta = self.undoStack.pop()
+        self.redoStack.append(delta)
+        return delta
+
+    def Redo(self) -> Delta | None:
+        """ Put the newest undone edit back on the journal, the caller writes back its new values. """
+        self.EndStroke()
+        if not self.redoStack:
+            return None
+        delta = self.redoStack.pop()
+        self.undoStack.append(delta)
+        return delta
+
+    def Clear(self) -> None:
+        """ Forget every edit. """
+        self.undoStack.clear()
+        self.redoStack.clear()
+        self.memoryUsed = 0
+        self.strokeTarget, self.strokeCells = None, {}
@@ -0,0 +1,185 @@
+# for vectorized hashing and remapping
+import numpy
+
+# project data is only needed for annotations (the project module imports this one through files)
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from .project import ProjectData
+
+# various data types used in this project
+from . import data
+
+# for every flip of a tile
+from . import render
+
+def DedupeVariants(variants: numpy.ndarray) -> tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+    """ Group items that are equal in any flip, given every flip of them (items, 4, ...).
+        Returns the items to keep (the first of each group), and for every item its group and the flips that turn the kept item into it. """
+    count = len(variants)
+    if not count:
+        return numpy.zeros(0, dtype=numpy.intp), numpy.zeros(0, dtype=numpy.intp), numpy.zeros(0, dtype=numpy.uint8)
+
+    # hash key of every variant: its raw bytes as one comparable value
+    flat = numpy.ascontiguousarray(variants).reshape(count, 4, -1)
+    keys = flat.view(numpy.dtype((numpy.void, flat.shape[-1] * flat.dtype.itemsize))).reshape(count, 4)
+
+    # canonical form: the smallest variant, and the flips that turn the item into it
+    keyBytes = flat.view(numpy.uint8)
+    items = numpy.arange(count)
+    canonical = numpy.zeros(count, dtype=numpy.uint8)
+    for flips in range(1, 4):
+        # compare the variant to the smallest so far at their first differing byte
+        best = keyBytes[items, canonical]
+        differs = keyBytes[:, flips] != best
+        first = differs.argmax(axis=1)
+        smaller = differs.any(axis=1) & (keyBytes[items, flips, first] < best[items, first])
+        canonical[smaller] = flips
+    canonicalKeys = keys[items, canonical]
+
+    # group equal canonical forms, numbered in order of first appearance
+    _, firstItems, groups = numpy.unique(canonicalKeys, return_index=True, return_inverse=True)
+    order = numpy.argsort(firstItems)
+    rank = numpy.empty(len(order), dtype=numpy.intp)
+    rank[order] = numpy.arange(len(order))
+    keep = firstItems[order]
+    groups = rank[groups.reshape(-1)]
+
+    # flips are their own inverse and combine with xor: item = flip(item -> canonical) of flip(kept -> canonical) of kept
+    flips = canonical ^ canonical[keep[groups]]
+    return keep, groups, flips
+
+def DedupeTiles(tileset: data.Tileset) -> tuple[data.Tileset, numpy.ndarray, numpy.ndarray]:
+    """ Merge tiles that are equal in any flip into one stored tile.
+        Returns the new tileset, and the new id and flips (bit 0 = horizontal, bit 1 = vertical) of every old tile. """
+    keep, ids, flips = DedupeVariants(render.FlipVariants(tileset.set & 0x0F))
+    return data.Tileset(len(keep), tileset.set[keep]), ids, flips
+
+def RemapTileWords(words: numpy.ndarray, ids: numpy.ndarray, flips: numpy.ndarray) -> numpy.ndarray:
+    """ Point nametable words at new tile ids, adding the flips each old tile needs (ids outside of the mapping are kept). """
+    words = numpy.asarray(words, dtype=numpy.uint16)
+    if not len(ids):
+        return words.copy()
+    tileIds = data.TileIds(words).astype(numpy.intp)
+    mapped = tileIds < len(ids)
+    safeIds = numpy.where(mapped, tileIds, 0)
+
+    # new id, and old flips xor the flips of the tile
+    newIds = numpy.where(mapped, ids[safeIds], tileIds)
+    newFlips = data.TileFlips(words) ^ numpy.where(mapped, flips[safeIds], 0)
+    attributes = words & (data.TILE_PRIORITY | data.TILE_PALETTE)
+    return (attributes | (newFlips << 11) | newIds).astype(numpy.uint16)
+
+def FlipChunks(chunks: numpy.ndarray) -> numpy.ndarray:
+    """ Get every flip of chunks of nametable words (..., size, size) as (..., 4, size, size), mirroring the tiles along with their positions. """
+    hFlipped = chunks[..., ::-1] ^ numpy.uint16(data.TILE_HFLIP)
+    vFlip = numpy.uint16(data.TILE_VFLIP)
+    return numpy.stack((chunks, hFlipped, chunks[..., ::-1, :] ^ vFlip, hFlipped[..., ::-1, :] ^ vFlip), axis=-3)
+
+def ChunkWords(ids: numpy.ndarray, flips: numpy.ndarray) -> numpy.ndarray:
+    """ Pack chunk ids and flips (bit 0 = horizontal, bit 1 = vertical) into tilemap words. """
+    flips = flips.astype(numpy.uint16)
+    return ((flips & 0b01) << 15) | ((flips & 0b10) << 13) | ids.astype(numpy.uint16)
+
+def LevelFromImage(pixels: numpy.ndarray, chunkSize: int) -> tuple[data.Tileset, data.Chunkset, data.Tilemap]:
+    """ Cut an image of color indices (palette * 16 + color) into deduplicated tiles and chunks, and a tilemap placing them.
+        The image is padded with color 0 to whole chunks, and each tile uses the highest palette line among its pixels. """
+    # pad to whole chunks
+    side = chunkSize * 8
+    height, width = pixels.shape
+    mapSize = (-(-width // side), -(-height // side))
+    padded = numpy.zeros((mapSize[1] * side, mapSize[0] * side), dtype=numpy.uint8)
+    padded[:height, :width] = pixels
+
+    # split into (tile row, y, tile column, x) and reorder into a list of 8x8 tiles
+    tilesHigh, tilesWide = mapSize[1] * chunkSize, mapSize[0] * chunkSize
+    tiles = padded.reshape(tilesHigh, 8, tilesWide, 8).swapaxes(1, 2).reshape(-1, 8, 8)
+
+    # merge equal tiles regardless of palette line, which stays in the nametable word
+    palettes = (tiles.max(axis=(1, 2)) >> 4) & 0b11
+    keepTiles, tileIds, tileFlips = DedupeVariants(render.FlipVariants(tiles & 0x0F))
+    if len(keepTiles) > data.TILE_ID + 1:
+        raise ValueError(f"the level needs {len(keepTiles)} tiles, more than the {data.TILE_ID + 1} a nametable word can reference")
+    words = (palettes.astype(numpy.uint16) << 13) | (tileFlips.astype(numpy.uint16) << 11) | tileIds.astype(numpy.uint16)
+
+    # split the words into chunks the same way, and merge equal chunks
+    chunks = words.reshape(mapSize[1], chunkSize, mapSize[0], chunkSize).swapaxes(1, 2).reshape(-1, chunkSize, chunkSize)
+    keepChunks, chunkIds, chunkFlips = DedupeVariants(FlipChunks(chunks))
+    if len(keepChunks) > data.CHUNK_ID + 1:
+        raise ValueError(f"the level needs {len(keepChunks)} chunks, more than the {data.CHUNK_ID + 1} a tilemap word can reference")
+
+    tileset = data.Tileset(len(keepTiles), tiles[keepTiles] & 0x0F)
+    chunkset = data.Chunkset(len(keepChunks), chunkSize, chunks[keepChunks])
+    tilemap = data.Tilemap(mapSize, ChunkWords(chunkIds, chunkFlips))
+    return tileset, chunkset, tilemap
+
+def DedupeChunks(chunkset: data.Chunkset) -> tuple[data.Chunkset, numpy.ndarray, numpy.ndarray]:
+    """ Merge chunks that are equal in any flip into one stored chunk.
+        Returns the new chunkset, and the new id and flips (bit 0 = horizontal, bit 1 = vertical) of every old chunk. """
+    keep, ids, flips = DedupeVariants(FlipChunks(chunkset.set))
+    return data.Chunkset(len(keep), chunkset.chunkSize, chunkset.set[keep]), ids, flips
+
+def RemapChunkWords(words: numpy.ndarray, ids: numpy.ndarray, flips: numpy.ndarray) -> numpy.ndarray:
+    """ Point tilemap words at new chunk ids, adding the flips each old chunk needs (ids outside of the mapping are kept). """
+    words = numpy.asarray(words, dtype=numpy.uint16)
+    if not len(ids):
+        return words.copy()
+    chunkIds = data.ChunkIds(words).astype(numpy.intp)
+    mapped = chunkIds < len(ids)
+    safeIds = numpy.where(mapped, chunkIds, 0)
+
+    # new id, and old flips xor the flips of the chunk
+    newIds = numpy.where(mapped, ids[safeIds], chunkIds)
+    newFlips = data.ChunkFlips(words) ^ numpy.where(mapped, flips[safeIds], 0)
+    return ChunkWords(newIds, newFlips)
+
+def CompactIds(used: numpy.ndarray, maxId: int) -> numpy.ndarray:
+    """ Get the new id of every id up to maxId once the unused ones are dropped (ids past the used flags shift down with the rest). """
+    mapping = numpy.empty(max(maxId + 1, len(used)), dtype=numpy.intp)
+    mapping[:len(used)] = numpy.cumsum(used) - 1
+    mapping[len(used):] = numpy.arange(len(used), len(mapping)) - (len(used) - numpy.count_nonzero(used))
+    return mapping
+
+def CompactProject(tileset: data.Tileset, chunkset: data.Chunkset, tilemap: data.Tilemap, keepFirst: bool=True) -> tuple[data.Tileset, data.Chunkset, data.Tilemap, int]:
+    """ Drop the chunks the tilemap doesn't reference and the tiles those chunks don't reference, renumbering the rest.
+        The first tile and chunk are kept by default, since engines use them as blanks. Returns the new assets and the bytes saved. """
+    # chunks the tilemap reaches
+    chunkIds = data.ChunkIds(tilemap.map).reshape(-1)
+    usedChunks = numpy.bincount(chunkIds[chunkIds < chunkset.size], minlength=chunkset.size) > 0
+    usedChunks[:1] |= keepFirst
+
+    # tiles the used chunks reach
+    tileIds = data.TileIds(chunkset.set[usedChunks]).reshape(-1)
+    usedTiles = numpy.bincount(tileIds[tileIds < tileset.size], minlength=tileset.size) > 0
+    usedTiles[:1] |= keepFirst
+
+    # renumber the survivors and rewrite the references to them in bulk
+    tileMapping = CompactIds(usedTiles, data.TILE_ID)
+    chunkMapping = CompactIds(usedChunks, data.CHUNK_ID)
+    words = RemapTileWords(chunkset.set[usedChunks], tileMapping, numpy.zeros(len(tileMapping), dtype=numpy.uint8))
+    map = RemapChunkWords(tilemap.map, chunkMapping, numpy.zeros(len(chunkMapping), dtype=numpy.uint8))
+
+    # 32 bytes per 4bpp tile, 2 bytes per chunk word
+    tilesRemoved = tileset.size - numpy.count_nonzero(usedTiles)
+    chunksRemoved = chunkset.size - numpy.count_nonzero(usedChunks)
+    savedBytes = int(tilesRemoved * 32 + chunksRemoved * chunkset.chunkSize * chunkset.chunkSize * 2)
+
+    compactTileset = data.Tileset(tileset.size - tilesRemoved, tileset.set[usedTiles])
+    compactChunkset = data.Chunkset(chunkset.size - chunksRemoved, chunkset.chunkSize, words)
+    return compactTileset, compactChunkset, data.Tilemap(tilemap.size, map), savedBytes
+
+def MergeTiles(projectData: "ProjectData") -> None:
+    """ Merge duplicate and mirrored tiles of a project, pointing its chunkset at the tiles that are kept. """
+    projectData.tileset, ids, flips = DedupeTiles(projectData.tileset)
+    projectData.chunkset.set[...] = RemapTileWords(projectData.chunkset.set, ids, flips)
+    projectData.chunkset.Reindex()
+
+def MergeChunks(projectData: "ProjectData") -> None:
+    """ Merge duplicate and mirrored chunks of a project, pointing its tilemap at the chunks that are kept. """
+    projectData.chunkset, ids, flips = DedupeChunks(projectData.chunkset)
+    projectData.tilemap.map[...] = RemapChunkWords(projectData.tilemap.map, ids, flips)
+    projectData.tilemap.Reindex()
+
+def RemoveUnused(projectData: "ProjectData") -> int:
+    """ Drop the tiles and chunks a project never reaches from its tilemap, returning the bytes saved. """
+    projectData.tileset, projectData.chunkset, projectData.tilemap, savedBytes = CompactProject(projectData.tileset, projectData.chunkset, projectData.tilemap)
+    return savedBytes
@@ -1,11 +1,15 @@
 from dataclasses import dataclass
 
-# gui
-from PyQt6 import QtWidgets as qtw
+# for packing the binary project format
+import struct
+import numpy
 
 # various data types used in this project
 from . import data
 
+# for reading old json projects
+from . import files
+
 @dataclass
 class ProjectData:
     # define sets and maps
@@ -24,3 +28,146 @@ def NewProjectFile() -> ProjectData:
     # create project dataclass
     projectFile = ProjectData(palettes, tileset, chunkset, tilemap)
     return projectFile
+
+# binary project file layout:
+#   header:  magic (4 bytes), version (u16), section count (u16)
+#   section: tag (4 bytes), payload length (u32), payload (padded to 4 bytes)
+# every number is little endian so arrays can be used straight from the file buffer
+PROJECT_MAGIC = b"TGE\x00"
+PROJECT_VERSION = 1
+PROJECT_HEADER = struct.Struct("<4sHH")
+SECTION_HEADER = struct.Struct("<4sI")
+
+def WriteProjectFile(projectData: ProjectData, filepath: str) -> None:
+    """ Write the project as a binary project file. """
+    # palettes: (palettes, 16, rgb) bytes
+    palettes = numpy.array([[(c.red, c.green, c.blue) for c in pal.palette] for pal in projectData.palettes], dtype=numpy.uint8)
+
+    # every section is a small header of sizes followed by a packed array
+    sections = [
+        (b"PALS", struct.pack("<I", len(projectData.palettes)), palettes),
+        (b"TILE", struct.pack("<I", projectData.tileset.size), projectData.tileset.set),
+        (b"CHNK", struct.pack("<II", projectData.chunkset.size, projectData.chunkset.chunkSize), projectData.chunkset.set.astype("<u2")),
+        (b"TMAP", struct.pack("<II", *projectData.tilemap.size), projectData.tilemap.map.astype("<u2"))
+    ]
+
+    with open(filepath, "wb") as file:
+        file.write(PROJECT_HEADER.pack(PROJECT_MAGIC, PROJECT_VERSION, len(sections)))
+
+        for tag, sizes, array in sections:
+            # pad the payload so the next section stays aligned
+            payload = sizes + array.tobytes()
+            padding = -len(payload) % 4
+
+            file.write(SECTION_HEADER.pack(tag, len(payload)))
+            file.write(payload)
+            file.write(bytes(padding))
+
+def ReadProjectFile(filepath: str) -> ProjectData:
+    """ Read a project file (binary or old json). """
+    # read the whole file into one writable buffer that the arrays can share
+    with open(filepath, "rb") as file:
+        buffer = bytearray(file.read())
+
+    # old projects are json
+    if buffer.lstrip()[:1] == b"{":
+        return ReadProjectJson(files.ReadJson(filepath))
+
+    # check the header
+    if len(buffer) < PROJECT_HEADER.size:
+        raise ValueError(f"utils/project.py: ReadProjectFile: {filepath} is not a project file.")
+    magic, version, sectionCount = PROJECT_HEADER.unpack_from(buffer, 0)
+    if magic != PROJECT_MAGIC:
+        raise ValueError(f"utils/project.py: ReadProjectFile: {filepath} is not a project file.")
+    if version > PROJECT_VERSION:
+        raise ValueError(f"utils/project.py: ReadProjectFile: {filepath} was saved by a newer version (format {version}).")
+
+    # find every section
+    sections = {}
+    offset = PROJECT_HEADER.size
+    for i in range(sectionCount):
+        tag, length = SECTION_HEADER.unpack_from(buffer, offset)
+        offset += SECTION_HEADER.size
+        sections[tag] = memoryview(buffer)[offset:offset+length]
+        offset += length + (-length % 4)
+    
+    # start from a blank project so missing sections keep their defaults
+    projectData = NewProjectFile()
+
+    # palettes
+    if b"PALS" in sections:
+        section = sections[b"PALS"]
+        (count,) = struct.unpack_from("<I", section, 0)
+        colors = numpy.frombuffer(section, dtype=numpy.uint8, count=count * 48, offset=4).reshape(count, 16, 3)
+        projectData.palettes = [data.Palette([data.Color(*color) for color in pal.tolist()]) for pal in colors]
+
+    # tileset
+    if b"TILE" in sections:
+        section = sections[b"TILE"]
+        (size,) = struct.unpack_from("<I", section, 0)
+        projectData.tileset = data.Tileset(size, numpy.frombuffer(section, dtype=numpy.uint8, count=size * 64, offset=4))
+
+    # chunkset
+    if b"CHNK" in sections:
+        section = sections[b"CHNK"]
+        size, chunkSize = struct.unpack_from("<II", section, 0)
+        words = numpy.frombuffer(section, dtype="<u2", count=size * chunkSize * chunkSize, offset=8)
+        projectData.chunkset = data.Chunkset(size, chunkSize, words)
+
+    # tilemap
+    if b"TMAP" in sections:
+        section = sections[b"TMAP"]
+        width, height = struct.unpack_from("<II", section, 0)
+        words = numpy.frombuffer(section, dtype="<u2", count=width * height, offset=8)
+        projectData.tilemap = data.Tilemap((width, height), words)
+
+    return projectData
+
+def ReadProjectJson(jsonData: dict) -> ProjectData:
+    """ Read a project saved in the old json format. """
+    # palettes
+    palettes = [
+        data.Palette(
+            [data.Color(col[0], col[1], col[2]) for col in jsonData["palettes"][palIndex]]
+        ) for palIndex in range(4)
+    ]
+    
+    # tileset
+    tileset = data.Tileset(jsonData["tileset"]["size"], jsonData["tileset"]["set"])
+    
+    # chunkset
+    chunkset = data.Chunkset(
+        jsonData["chunkset"]["size"],
+        jsonData["chunkset"]["chunkSize"],
+
+        [
+            [
+                [
+                    data.Tile(
+                        tile[0], # palette index
+                        tile[1], # tile id
+                        tile[2], # tile priority
+                        tile[3], # tile horizontal flip
+                        tile[4] # tile vertical flip
+                    ).Pack() for tile in row
+                ] for row in chunk
+            ] for chunk in jsonData["chunkset"]["set"]
+        ]
+    )
+    
+    # tilemap
+    tilemap = data.Tilemap(
+        jsonData["tilemap"]["size"],
+
+        [
+            [
+                data.Chunk(
+                    chunk[0], # chunk id
+                    chunk[1], # chunk horizontal flip
+                    chunk[2] # chunk vertical flip
+                ).Pack() for chunk in row
+            ] for row in jsonData["tilemap"]["map"]
+        ]
+    )
+
+    return ProjectData(palettes, tileset, chunkset, tilemap)
@@ -0,0 +1,241 @@
+# for bulk image composition
+import numpy
+
+# for rendering on worker threads
+import threading
+
+# custom data formats
+from . import data
+
+def PalettesARGB(palettes: list[data.Palette]) -> numpy.ndarray:
+    """ Convert palettes into a (palettes, 16) table of 32bit ARGB (Alpha, Red, Green, Blue) colors. """
+    # pack the rgb channels of every color
+    table = numpy.array([
+        [(c.red << 16) | (c.green << 8) | c.blue for c in pal.palette] for pal in palettes
+    ], dtype=numpy.uint32)
+
+    # 1st color in palette is transparent, every other color is opaque
+    table[:, 0] = 0
+    table[:, 1:] |= 0xFF000000
+    return table
+
+def FlipImages(images: numpy.ndarray, flips: numpy.ndarray) -> numpy.ndarray:
+    """ Flip a stack of images (..., height, width) by their flips (bit 0 = horizontal, bit 1 = vertical). """
+    # broadcast the flips over the pixels of each image
+    hFlips = ((flips & 0b01) != 0)[..., None, None]
+    vFlips = ((flips & 0b10) != 0)[..., None, None]
+
+    # choose between each image and its mirrored view
+    images = numpy.where(hFlips, images[..., :, ::-1], images)
+    return numpy.where(vFlips, images[..., ::-1, :], images)
+
+def Sheet(images: numpy.ndarray, columns: int) -> numpy.ndarray:
+    """ Lay a stack of images (count, height, width) out in a grid with a set amount of columns. """
+    # pad with blank images to fill the last row
+    count, height, width = images.shape[:3]
+    rows = -(-count // columns)
+    if rows * columns != count:
+        padding = numpy.zeros((rows * columns - count, height, width), dtype=images.dtype)
+        images = numpy.concatenate((images, padding))
+
+    # interleave image rows with grid columns
+    return images.reshape(rows, columns, height, width).transpose(0, 2, 1, 3).reshape(rows * height, columns * width)
+
+def FlipVariants(tiles: numpy.ndarray) -> numpy.ndarray:
+    """ Stack every flip of a set of tiles (..., 8, 8) into (..., 4, 8, 8), indexed by flips (bit 0 = horizontal, bit 1 = vertical). """
+    return numpy.stack((tiles, tiles[..., :, ::-1], tiles[..., ::-1, :], tiles[..., ::-1, ::-1]), axis=-3)
+
+class TileAtlas:
+    """ Shared cache of every tile pre-rendered in every flip as color indices (palette * 16 + color). """
+    def __init__(self, palettes: list[data.Palette], tileset: data.Tileset):
+        # define globals
+        self.palettes = palettes
+        self.tileset = tileset
+        self.table = PalettesARGB(palettes)
+
+        # color indices (within a palette) indexed by [tile id, flips], plus a blank tile for ids outside of the tileset
+        self.images = numpy.zeros((tileset.size + 1, 4, 8, 8), dtype=numpy.uint8)
+
+        # everything needs to be rendered the first time it is used
+        self.dirtyTiles = numpy.ones(tileset.size, dtype=bool)
+        self.dirtyPalettes = numpy.zeros(len(palettes), dtype=bool)
+
+        # render threads and the gui thread take turns refreshing and reading (reentrant so readers can refresh first)
+        self.lock = threading.RLock()
+    
+    def InvalidateTiles(self, tileIds: list[int] | None=None) -> None:
+        """ Mark tiles (all by default) as changed. """
+        if tileIds is None:
+            self.dirtyTiles[:] = True
+        else:
+            self.dirtyTiles[tileIds] = True
+    
+    def InvalidatePalette(self, paletteIndex: int) -> None:
+        """ Mark a palette as changed. """
+        self.dirtyPalettes[paletteIndex] = True
+    
+    def Refresh(self) -> None:
+        """ Re-render every changed tile and palette. """
+        with self.lock:
+            # palettes only change the color table (marks are cleared first so changes made meanwhile aren't lost)
+            for paletteIndex in numpy.flatnonzero(self.dirtyPalettes):
+                self.dirtyPalettes[paletteIndex] = False
+                self.table[paletteIndex] = PalettesARGB([self.palettes[paletteIndex]])[0]
+
+            # re-render the changed tiles in every flip
+            if self.dirtyTiles.any():
+                tileIds = numpy.flatnonzero(self.dirtyTiles)
+                self.dirtyTiles[tileIds] = False
+                self.images[tileIds] = FlipVariants(self.tileset.set[tileIds] & 0x0F)
+    
+    def ColorTable(self, paletteIndex: int | None=None) -> list[int]:
+        """ Get the ARGB colors of one palette (16 entries) or of every palette (palettes * 16 entries) for indexed images. """
+        with self.lock:
+            self.Refresh()
+            if paletteIndex is None:
+                return self.table.reshape(-1).tolist()
+            return self.table[paletteIndex].tolist()
+    
+    def ToARGB(self, indices: numpy.ndarray) -> numpy.ndarray:
+        """ Convert an array of color indices (palette * 16 + color) to ARGB colors. """
+        with self.lock:
+            self.Refresh()
+            return self.table.reshape(-1)[indices]
+    
+    def GetTiles(self, paletteIndex: int, flips: int=0) -> numpy.ndarray:
+        """ Get the color indices of every tile (tiles, 8, 8) in one palette and flip. """
+        with self.lock:
+            self.Refresh()
+            return self.images[:-1, flips] | numpy.uint8(paletteIndex << 4)
+    
+    def Lookup(self, words: numpy.ndarray) -> numpy.ndarray:
+        """ Get the color indices of the tiles (..., 8, 8) of an array of nametable words. """
+        # tiles outside of the tileset use the blank tile
+        ids = numpy.minimum(data.TileIds(words), self.tileset.size)
+        palettes = (data.TilePalettes(words) << 4).astype(numpy.uint8)
+        with self.lock:
+            self.Refresh()
+            return self.images[ids, data.TileFlips(words)] | palettes[..., None, None]
+
+def RenderChunks(atlas: TileAtlas, chunkset: data.Chunkset, chunkIds: numpy.ndarray | list[int] | None=None) -> numpy.ndarray:
+    """ Render chunks (all by default) into an array of (count, chunkSize * 8, chunkSize * 8) color index images. """
+    # get the nametable words of the requested chunks
+    words = chunkset.set if chunkIds is None else chunkset.set[chunkIds]
+
+    # blit every tile from the atlas then stitch the tiles of each chunk together
+    tiles = atlas.Lookup(words) # (count, tile y, tile x, y, x)
+    count, size = words.shape[0], chunkset.chunkSize * 8
+    return tiles.transpose(0, 1, 3, 2, 4).reshape(count, size, size)
+
+def Downsample(images: numpy.ndarray) -> numpy.ndarray:
+    """ Halve a stack of ARGB images (..., height, width) by averaging 2x2 squares of pixels (odd edges are padded with transparent pixels). """
+    # pad odd sizes
+    height, width = images.shape[-2:]
+    if height % 2 or width % 2:
+        padding = [(0, 0)] * (images.ndim - 2) + [(0, height % 2), (0, width % 2)]
+        images = numpy.pad(images, padding)
+        height, width = images.shape[-2:]
+
+    # average each channel of every 2x2 square
+    channels = numpy.ascontiguousarray(images).view(numpy.uint8).reshape(*images.shape[:-2], height // 2, 2, width // 2, 2, 4)
+    average = (channels.sum(axis=(-4, -2), dtype=numpy.uint16) + 2) // 4
+    return numpy.ascontiguousarray(average.astype(numpy.uint8)).view(numpy.uint32)[..., 0]
+
+class ChunkMips:
+    """ Cache of every chunk rendered at full size (as color indices) and at every halved size that is still a whole number of pixels (as ARGB colors). """
+    def __init__(self, atlas: TileAtlas, chunkset: data.Chunkset):
+        # define globals
+        self.atlas = atlas
+        self.chunkset = chunkset
+
+        # chunks can be halved as many times as their size is divisible by 2
+        size = chunkset.chunkSize * 8
+        self.maxLevel = (size & -size).bit_length() - 1
+
+        # images of every level indexed by [chunk id], plus a blank chunk for ids outside of the chunkset
+        self.levels = [numpy.zeros((chunkset.size + 1, size >> level, size >> level), dtype=numpy.uint8 if level == 0 else numpy.uint32) for level in range(self.maxLevel + 1)]
+        self.dirtyChunks = numpy.ones(chunkset.size, dtype=bool)
+        self.renderingChunks = numpy.zeros(chunkset.size, dtype=bool) # claimed by a thread that is rendering them
+
+        # threads claim and swap in chunks under the lock, but render outside of it
+        self.lock = threading.Lock()
+        self.rendered = threading.Condition(self.lock)
+    
+    def InvalidateChunks(self, chunkIds: list[int] | numpy.ndarray | None=None) -> None:
+        """ Mark chunks (all by default) as changed. """
+        with self.lock:
+            if chunkIds is None:
+                self.dirtyChunks[:] = True
+            else:
+                self.dirtyChunks[chunkIds] = True
+    
+    def GetLevel(self, level: int, chunkIds: numpy.ndarray | None=None) -> numpy.ndarray:
+        """ Get every chunk (chunks + 1, size, size) shrunk 2**level times, re-rendering the changed ones among chunkIds (all by default). """
+        # chunks that are needed (ids outside of the chunkset use the blank chunk)
+        needed = numpy.zeros(self.chunkset.size, dtype=bool)
+        if chunkIds is None:
+            needed[:] = True
+        else:
+            ids = numpy.asarray(chunkIds).reshape(-1)
+            needed[ids[ids < self.chunkset.size]] = True
+
+        # claim the changed ones (marks are cleared first so changes made meanwhile aren't lost)
+        with self.lock:
+            claimed = numpy.flatnonzero(needed & self.dirtyChunks & ~self.renderingChunks)
+            self.dirtyChunks[claimed] = False
+            self.renderingChunks[claimed] = True
+
+        if len(claimed):
+            levels = []
+            try:
+                # render them then color and shrink them level by level, without blocking other threads
+                images = RenderChunks(self.atlas, self.chunkset, claimed)
+                levels.append(images)
+                images = self.atlas.ToARGB(images)
+                for i in range(self.maxLevel):
+                    images = Downsample(images)
+                    levels.append(images)
+            finally:
+                with self.lock:
+                    # swap the finished images in (or give the chunks back if rendering failed)
+                    if len(levels) == len(self.levels):
+                        for levelImages, images in zip(self.levels, levels):
+                            levelImages[claimed] = images
+                    else:
+                        self.dirtyChunks[claimed] = True
+                    self.renderingChunks[claimed] = False
+                    self.rendered.notify_all()
+
+        # wait for needed chunks that other threads are still rendering
+        with self.lock:
+            while (needed & self.renderingChunks).any():
+                self.rendered.wait()
+            return self.levels[level]
+
+def RenderMapRect(mips: ChunkMips, words: numpy.ndarray, rect: tuple[int, int, int, int], level: int=0) -> numpy.ndarray:
+    """ Render the pixels of a tilemap inside rect (x, y, width, height, aligned to 2**level) shrunk 2**level times (color indices at full size, ARGB colors when shrunk). """
+    x, y, width, height = rect
+
+    # every cell touched by the rect
+    cellSize = mips.chunkset.chunkSize * 8 # size of a cell at full size
+    cellX0, cellY0 = x // cellSize, y // cellSize
+    cells = words[cellY0:-(-(y + height) // cellSize), cellX0:-(-(x + width) // cellSize)]
+    ids = numpy.minimum(data.ChunkIds(cells), mips.chunkset.size)
+
+    # use the smallest chunk images that are still at least as big as the level (only the chunks of these cells need to be current)
+    chunkLevel = min(level, mips.maxLevel)
+    chunks = mips.GetLevel(chunkLevel, numpy.unique(ids))
+
+    # place the chunk of every cell, apply its flips and stitch them together
+    images = FlipImages(chunks[ids], data.ChunkFlips(cells))
+    rows, columns, size = images.shape[0], images.shape[1], images.shape[-1]
+    image = images.transpose(0, 2, 1, 3).reshape(rows * size, columns * size)
+
+    # crop to the rect then shrink the rest of the way
+    offsetX, offsetY = (x - cellX0 * cellSize) >> chunkLevel, (y - cellY0 * cellSize) >> chunkLevel
+    image = image[offsetY:offsetY + -(-height >> chunkLevel), offsetX:offsetX + -(-width >> chunkLevel)]
+    if level > chunkLevel and chunkLevel == 0:
+        image = mips.atlas.ToARGB(image)
+    for i in range(level - chunkLevel):
+        image = Downsample(image)
+    return image